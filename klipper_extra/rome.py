@@ -1,8 +1,14 @@
+import os
+import json
+import zlib
 import time
 from ssl import SSLSocket
-from math import fabs
+from math import fabs, sqrt
+from bisect import bisect_left
 from re import T
 import logging
+import collections
+import chelper
 
 class ROME:
 
@@ -15,18 +21,14 @@ class ROME:
         self.reactor = self.printer.get_reactor()
         self.gcode = self.printer.lookup_object('gcode')
         self.toolhead_filament_sensor = self.printer.lookup_object("filament_switch_sensor toolhead_filament_sensor")
-        self.f1_filament_sensor = None
-        self.f2_filament_sensor = None
-        self.y1_filament_sensor = None
-        self.y2_filament_sensor = None
         self.z_filament_sensor = None
 
         self.load_settings()
         self.register_commands()
+        self.register_endpoints()
         self.register_handle_connect()
 
     def load_settings(self):
-        self.idler_stepper = None
 
         self.rome_setup = self.config.getint('rome_setup', 0)
 
@@ -41,14 +43,44 @@ class ROME:
         self.wipe_tower_acceleration = self.config.getfloat('wipe_tower_acceleration', 5000.0)
         self.use_ooze_ex = self.config.getfloat('use_ooze_ex', 1)
 
+        # kinematic profiles per tool change phase, optionally per lane
+        self.Kinematic_Profiles = {}
+        for phase in self.kinematic_profile_phases:
+            for lane in range(0, self.tool_count + 1):
+                option = 'kinematic_profile_' + phase
+                if lane > 0:
+                    option = option + '_' + str(lane)
+                value = self.config.get(option, None)
+                if value is not None:
+                    self.Kinematic_Profiles[(phase, lane)] = self.parse_kinematic_profile(option, value)
+        if ('change', 0) not in self.Kinematic_Profiles:
+            self.Kinematic_Profiles[('change', 0)] = {'accel': self.wipe_tower_acceleration}
+        self.Saved_Kinematic_Limits = None
+
         self.runout_detected = False
-        self.infinite_spool = False
+        if self.config.getfloat('infinite_spool', 0) == 1:
+            self.infinite_spool_default = True
+        else:
+            self.infinite_spool_default = False
+        self.infinite_spool = self.infinite_spool_default
+        self.Infinite_Spool_Backup = {}
+        for tools in self.parse_lists(self.config.get('infinite_spool_backup', '1:2,2:1')):
+            if len(tools) != 2:
+                raise self.config.error("infinite_spool_backup must be a list of tool:backup_tool pairs")
+            self.Infinite_Spool_Backup[tools[0]] = tools[1]
+        self.runout_reserve_mm = self.config.getfloat('runout_reserve_mm', 1000.0, minval=0.)
+
+        self.Tool_Mapping = {}
+        self.Filament_Usage = []
+        self.Spool_Remaining = []
+        for i in range(1, self.tool_count + 1):
+            self.Filament_Usage.append(0.)
+            self.Spool_Remaining.append(None)
 
         if self.config.getfloat('use_filament_caching', 1) == 1:
             self.use_filament_caching = True
         else:
             self.use_filament_caching = False
-        #self.Filament_Groups = self.config.getlists('filament_groups', None)
 
         if self.config.getfloat('extruder_push_and_pull_test', 1) == 1:
             self.extruder_push_and_pull_test = True
@@ -56,6 +88,9 @@ class ROME:
             self.extruder_push_and_pull_test = False
 
         self.nozzle_loading_speed_mms = self.config.getfloat('nozzle_loading_speed_mms', 10.0)
+        self.nozzle_max_volumetric_flow = self.config.getfloat('nozzle_max_volumetric_flow', 0., minval=0.)
+        self.nozzle_melt_zone_mm = self.config.getfloat('nozzle_melt_zone_mm', 20.0, above=0.)
+        self.nozzle_loading_temperature_boost = self.config.getfloat('nozzle_loading_temperature_boost', 0., minval=0.)
         self.filament_homing_speed_mms = self.config.getfloat('filament_homing_speed_mms', 75.0)
         self.filament_parking_speed_mms = self.config.getfloat('filament_parking_speed_mms', 50.0)
 
@@ -64,37 +99,239 @@ class ROME:
         self.toolhead_sensor_to_extruder_gear_mm = self.config.getfloat('toolhead_sensor_to_extruder_gear_mm', 45.0)
         self.extruder_gear_to_parking_position_mm = self.config.getfloat('extruder_gear_to_parking_position_mm', 40.0)
         self.parking_position_to_nozzle_mm = self.config.getfloat('parking_position_to_nozzle_mm', 65.0)
+        self.nozzle_unload_time = self.config.getfloat('nozzle_unload_time', 5.0, minval=0.)
+
+        self.Purge_Matrix = self.parse_purge_matrix(self.config.get('purge_matrix', ''), self.config.error)
+
+        if self.config.getfloat('log_messages', 0) == 1:
+            self.log_messages = True
+        else:
+            self.log_messages = False
+
+        if self.config.getfloat('sensor_telemetry', 0) == 1:
+            self.sensor_telemetry = True
+        else:
+            self.sensor_telemetry = False
+        self.sensor_telemetry_size = self.config.getint('sensor_telemetry_size', 2000, minval=10)
+        if self.config.getfloat('sensor_telemetry_dump_on_pause', 1) == 1:
+            self.sensor_telemetry_dump_on_pause = True
+        else:
+            self.sensor_telemetry_dump_on_pause = False
+        self.sensor_telemetry_file = os.path.expanduser(self.config.get('sensor_telemetry_file', '~/rome_sensors.csv'))
+        self.Sensor_Telemetry = collections.deque(maxlen=self.sensor_telemetry_size)
+        self.Trace = None
+        self.Trace_Phases = []
+
+        self.recovery_attempts = self.config.getint('recovery_attempts', 3, minval=0)
+        self.recovery_backoff_mm = self.config.getfloat('recovery_backoff_mm', 30.0, above=0.)
+        self.recovery_speed_factor = self.config.getfloat('recovery_speed_factor', 0.5, above=0., maxval=1.)
+        self.Recovery_Strategies = []
+        for strategy in self.config.get('recovery_strategies', 'backoff, slow, home_idler, wide_positioning').split(','):
+            strategy = strategy.strip()
+            if strategy not in self.recovery_strategy_names:
+                raise self.config.error("Unknown recovery strategy '" + strategy + "', use " + ", ".join(self.recovery_strategy_names))
+            if strategy == 'home_idler' and self.rome_setup != 1:
+                continue
+            self.Recovery_Strategies.append(strategy)
+        if len(self.Recovery_Strategies) == 0:
+            self.recovery_attempts = 0
+        self.Recovery_Log = collections.deque(maxlen=50)
+
+        self.lane_wear_warning_mm = self.config.getfloat('lane_wear_warning_mm', 10.0, above=0.)
+        self.lane_wear_warning_stddev_mm = self.config.getfloat('lane_wear_warning_stddev_mm', 5.0, above=0.)
+        self.Lane_Wear = []
+        for i in range(1, self.tool_count + 1):
+            self.Lane_Wear.append({})
+
+        self.Tool_Temperatures = self.get_lane_list('tool_temperatures', [0.] * self.tool_count, float)
+        self.Print_Tool_Temperatures = None
+        self.Print_Purge_Matrix = None
+        self.Slicer_Tool = -1
+        self.Change_Slicer_Tool = -1
+
+        self.load_topology()
+
+        self.Statistics = {}
+        for statistic_name in self.statistic_names:
+            self.Statistics[statistic_name] = 0
+        self.init_metrics()
+        self.Lane_Moves = {}
+        self.Staged_Tool = None
+
+        self.Cost_Factors = {}
+        self.Phase_Estimates = {}
+        self.Planned_Changes = None
+
+        if self.config.getfloat('stallguard_monitoring', 0) == 1:
+            self.stallguard_monitoring = True
+        else:
+            self.stallguard_monitoring = False
+        self.stallguard_threshold = self.config.getint('stallguard_threshold', -1)
+        self.stallguard_check_distance_mm = self.config.getfloat('stallguard_check_distance_mm', 20.0, above=0.)
+        self.stallguard_backoff_mm = self.config.getfloat('stallguard_backoff_mm', 10.0, minval=0.)
+        self.stallguard_retries = self.config.getint('stallguard_retries', 1, minval=0)
+
+        if self.config.getfloat('stage_first_tool', 1) == 1:
+            self.stage_first_tool = True
+        else:
+            self.stage_first_tool = False
+
+        if self.config.getfloat('persist_state', 0) == 1:
+            self.persist_state = True
+        else:
+            self.persist_state = False
+        self.state_file = os.path.expanduser(self.config.get('state_file', '~/rome_state.json'))
 
     def register_handle_connect(self):
         self.printer.register_event_handler("klippy:connect", self.execute_handle_connect)
+        self.printer.register_event_handler("klippy:ready", self.execute_handle_ready)
 
     def execute_handle_connect(self):
         self.toolhead = self.printer.lookup_object('toolhead')
+        self.mcu = self.printer.lookup_object('mcu')
         self.extruder = self.printer.lookup_object('extruder')
         self.pheaters = self.printer.lookup_object('heaters')
         self.heater = self.extruder.get_heater()
 
         if self.rome_setup == 1:
-            for manual_stepper in self.printer.lookup_objects('manual_stepper'):
-                rail_name = manual_stepper[1].get_steppers()[0].get_name()
-                if rail_name == 'manual_stepper idler_stepper':
-                    self.idler_stepper = manual_stepper[1]
-            if self.idler_stepper is None:
-                raise self.config.error("Idler Stepper not found!")
+            self.Unit_Idlers = []
+            for idler_name in self.Unit_Idler_Names:
+                idler_stepper = self.printer.lookup_object('manual_stepper ' + idler_name, None)
+                if idler_stepper is None:
+                    raise self.config.error("Idler Stepper " + idler_name + " not found!")
+                self.Unit_Idlers.append(idler_stepper)
 
         for filament_sensor in self.printer.lookup_objects('filament_switch_sensor'):
             sensor_name = filament_sensor[1].runout_helper.name
-            if sensor_name == 'feeder_1_filament_sensor':
-                self.f1_filament_sensor = filament_sensor[1]
-            if sensor_name == 'feeder_2_filament_sensor':
-                self.f2_filament_sensor = filament_sensor[1]
-            if sensor_name == 'y1_filament_sensor':
-                self.y1_filament_sensor = filament_sensor[1]
-            if sensor_name == 'y2_filament_sensor':
-                self.y2_filament_sensor = filament_sensor[1]
             if sensor_name == 'z_filament_sensor':
                 self.z_filament_sensor = filament_sensor[1]
 
+        self.build_topology()
+        self.register_sensor_telemetry()
+
+        self.load_state()
+
+    def execute_handle_ready(self):
+        # filament sensors report their initial state shortly after ready
+        if self.Stored_State is not None:
+            self.reactor.register_callback(self.restore_state, self.reactor.monotonic() + 2.)
+
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Topology
+    # -----------------------------------------------------------------------------------------------------------------------------
+    def load_topology(self):
+
+        # lane configuration, one entry per tool
+        default_extruders = []
+        default_feeder_sensors = []
+        default_y_sensors = []
+        default_idler_positions = []
+        for i in range(1, self.tool_count + 1):
+            default_extruders.append('rome_extruder_' + str(i))
+            default_feeder_sensors.append('feeder_' + str(i) + '_filament_sensor')
+            default_y_sensors.append('y1_filament_sensor' if i < 3 else 'y2_filament_sensor')
+            default_idler_positions.append(5.0 + 15.0 * (i - 1))
+        self.Lane_Extruders = self.get_lane_list('lane_extruders', default_extruders)
+        self.Lane_Feeder_Sensor_Names = self.get_lane_list('lane_feeder_sensors', default_feeder_sensors)
+        self.Lane_Y_Sensor_Names = self.get_lane_list('lane_y_sensors', default_y_sensors)
+        self.Lane_Idler_Positions = self.get_lane_list('lane_idler_positions', default_idler_positions, float)
+        self.Lane_Cache_mm = self.get_lane_list('lane_bowden_cache_mm', [self.toolhead_sensor_to_bowden_cache_mm] * self.tool_count, float)
+        self.Lane_Parking_mm = self.get_lane_list('lane_bowden_parking_mm', [self.toolhead_sensor_to_bowden_parking_mm] * self.tool_count, float)
+        self.lane_sensors_configured = self.config.get('lane_feeder_sensors', None) is not None or self.config.get('lane_y_sensors', None) is not None
+
+        # mmu splitter units, each with its own idler and pulley
+        self.Unit_Idler_Names = [name.strip() for name in self.config.get('unit_idlers', 'idler_stepper').split(',')]
+        self.Unit_Pulley_Names = [name.strip() for name in self.config.get('unit_pulleys', 'pulley_extruder').split(',')]
+        if len(self.Unit_Pulley_Names) != len(self.Unit_Idler_Names):
+            raise self.config.error("unit_idlers and unit_pulleys need one entry per mmu splitter unit")
+        self.Lane_Units = self.get_lane_list('lane_units', [1] * self.tool_count, int)
+        for unit in self.Lane_Units:
+            if unit < 1 or unit > len(self.Unit_Idler_Names):
+                raise self.config.error("lane_units references unknown unit " + str(unit))
+        self.Unit_Idler_Positions = [None] * len(self.Unit_Idler_Names)
+        self.Unit_Idlers = []
+
+        # idler travel, every lane position has to lie between the endstop and the home position
+        self.idler_home_position = self.config.getfloat('idler_home_position', 85.0, above=0.)
+        self.idler_homing_travel_mm = self.config.getfloat('idler_homing_travel_mm', 95.0, above=0.)
+        self.y_sensor_to_parking_position_mm = self.config.getfloat('y_sensor_to_parking_position_mm', 48.0, minval=0.)
+        if self.rome_setup == 1:
+            if self.idler_homing_travel_mm <= self.idler_home_position:
+                raise self.config.error("idler_homing_travel_mm has to be longer than idler_home_position")
+            for i in range(0, self.tool_count):
+                if self.Lane_Idler_Positions[i] < 0 or self.Lane_Idler_Positions[i] >= self.idler_home_position:
+                    raise self.config.error("Idler position " + str(self.Lane_Idler_Positions[i]) + " of lane " + str(i + 1) + " is outside of 0 - idler_home_position (" + str(self.idler_home_position) + "), configure lane_idler_positions")
+
+        # filament groups, lanes that share a bowden tube to the toolhead
+        if self.config.get('filament_groups', None) is None:
+            # the default groups only keep the lanes that exist
+            self.Filament_Groups = []
+            for group in self.parse_lists('1:2,4:5'):
+                group = [filament for filament in group if filament <= self.tool_count]
+                if len(group) > 1:
+                    self.Filament_Groups.append(group)
+        else:
+            self.Filament_Groups = self.parse_lists(self.config.get('filament_groups'), self.config.error)
+        self.Lane_Groups = [-1] * self.tool_count
+        for g in range(0, len(self.Filament_Groups)):
+            for filament in self.Filament_Groups[g]:
+                if filament < 1 or filament > self.tool_count:
+                    raise self.config.error("filament_groups references lane " + str(filament) + ", tool_count is " + str(self.tool_count))
+                if self.Lane_Groups[filament - 1] >= 0:
+                    raise self.config.error("filament_groups lists lane " + str(filament) + " in more than one group")
+                self.Lane_Groups[filament - 1] = g
+
+    def get_lane_list(self, option, default, parser=str):
+        value = self.config.get(option, None)
+        if value is None:
+            return default
+        items = []
+        for item in value.split(','):
+            item = item.strip()
+            if parser is str and (item.lower() == 'none' or item == ''):
+                items.append(None)
+            else:
+                try:
+                    items.append(parser(item))
+                except ValueError:
+                    raise self.config.error("Unable to parse '" + item + "' in option '" + option + "'")
+        if len(items) != self.tool_count:
+            raise self.config.error("Option '" + option + "' needs " + str(self.tool_count) + " entries, one per tool")
+        return items
+
+    def build_topology(self):
+
+        # resolve the filament sensors of all lanes once
+        self.Lane_Feeder_Sensors = []
+        self.Lane_Y_Sensors = []
+        for i in range(0, self.tool_count):
+            self.Lane_Feeder_Sensors.append(self.lookup_filament_sensor(self.Lane_Feeder_Sensor_Names[i]))
+            self.Lane_Y_Sensors.append(self.lookup_filament_sensor(self.Lane_Y_Sensor_Names[i]))
+
+    def lookup_filament_sensor(self, sensor_name):
+        if sensor_name is None:
+            return None
+        filament_sensor = self.printer.lookup_object('filament_switch_sensor ' + sensor_name, None)
+        if filament_sensor is None and self.lane_sensors_configured:
+            raise self.config.error("Filament sensor " + sensor_name + " not found!")
+        return filament_sensor
+
+    def get_lane_unit(self, tool):
+        return self.Lane_Units[tool - 1] - 1
+
+    def get_lane_extruder(self, tool):
+        return self.Lane_Extruders[tool - 1]
+
+    def get_bowden_cache_mm(self, tool):
+        if tool < 1 or tool > self.tool_count:
+            return self.toolhead_sensor_to_bowden_cache_mm
+        return self.Lane_Cache_mm[tool - 1]
+
+    def get_bowden_parking_mm(self, tool):
+        if tool < 1 or tool > self.tool_count:
+            return self.toolhead_sensor_to_bowden_parking_mm
+        return self.Lane_Parking_mm[tool - 1]
+
     # -----------------------------------------------------------------------------------------------------------------------------
     # Heater Timeout Handler
     # -----------------------------------------------------------------------------------------------------------------------------
@@ -126,33 +363,44 @@ class ROME:
         self.gcode.register_command('EJECT_TOOL', self.cmd_EJECT_TOOL, desc=("EJECT_TOOL"))
         self.gcode.register_command('CHANGE_TOOL', self.cmd_CHANGE_TOOL, desc=("CHANGE_TOOL"))
         self.gcode.register_command('ROME_END_PRINT', self.cmd_ROME_END_PRINT, desc=("ROME_END_PRINT"))
+        self.gcode.register_command('ROME_CANCEL_PRINT', self.cmd_ROME_CANCEL_PRINT, desc=("ROME_CANCEL_PRINT"))
         self.gcode.register_command('ROME_START_PRINT', self.cmd_ROME_START_PRINT, desc=("ROME_START_PRINT"))
         self.gcode.register_command('ROME_INSERT_GCODE', self.cmd_ROME_INSERT_GCODE, desc=("ROME_INSERT_GCODE"))
         self.gcode.register_command('ROME_RUNOUT_GCODE', self.cmd_ROME_RUNOUT_GCODE, desc=("ROME_RUNOUT_GCODE"))
         self.gcode.register_command('LOAD_FILAMENTS', self.cmd_LOAD_FILAMENTS, desc=("LOAD_FILAMENTS"))
+        self.gcode.register_command('SCAN_FILAMENTS', self.cmd_SCAN_FILAMENTS, desc=("SCAN_FILAMENTS"))
+        self.gcode.register_command('ROME_BENCHMARK', self.cmd_ROME_BENCHMARK, desc=("ROME_BENCHMARK"))
+        self.gcode.register_command('ROME_TRACE', self.cmd_ROME_TRACE, desc=("ROME_TRACE"))
+        self.gcode.register_command('ROME_PLAN', self.cmd_ROME_PLAN, desc=("ROME_PLAN"))
+        self.gcode.register_command('ROME_SENSOR_TELEMETRY', self.cmd_ROME_SENSOR_TELEMETRY, desc=("ROME_SENSOR_TELEMETRY"))
+        self.gcode.register_command('ROME_SENSOR_TELEMETRY_DUMP', self.cmd_ROME_SENSOR_TELEMETRY_DUMP, desc=("ROME_SENSOR_TELEMETRY_DUMP"))
         self.gcode.register_command('Z_HOME_TEST', self.cmd_Z_HOME_TEST, desc=("Z_HOME_TEST"))
         self.gcode.register_command('F_RUNOUT', self.cmd_F_RUNOUT, desc=("F_RUNOUT"))
         self.gcode.register_command('F_INSERT', self.cmd_F_INSERT, desc=("F_INSERT"))
         self.gcode.register_command('_SET_INFINITE_SPOOL', self.cmd_SET_INFINITE_SPOOL, desc=("SET_INFINITE_SPOOL"))
+        self.gcode.register_command('SET_SPOOL_LENGTH', self.cmd_SET_SPOOL_LENGTH, desc=("SET_SPOOL_LENGTH"))
 
     def cmd_SELECT_TOOL(self, param):
         tool = param.get_int('TOOL', None, minval=-1, maxval=self.tool_count)
         self.select_tool(tool)
+        self.save_state()
 
     def cmd_LOAD_TOOL(self, param):
         self.cmd_origin = "gcode"
         tool = param.get_int('TOOL', None, minval=0, maxval=self.tool_count)
         temp = param.get_int('TEMP', None, minval=-1, maxval=self.heater.max_temp)
+        self.save_state(True)
         
         # load tool
-        if not self.load_tool(tool, temp, True):
+        if not self.load_tool(tool, temp, True) and not self.recover_tool_change(tool, temp, True):
 
             # send notification
-            self.gcode.run_script_from_command('_EXTRUDER_ERROR EXTRUDER=' + str(tool))
+            self.run_gcode('_EXTRUDER_ERROR EXTRUDER=' + str(tool))
 
             self.pause_rome()
             return
         
+        self.save_state()
         return
     
     def cmd_UNLOAD_TOOL(self, param):
@@ -165,40 +413,71 @@ class ROME:
             self.set_hotend_temperature(temp)
 
         # unload tool
+        self.save_state(True)
         self.Selected_Filament = tool
         if self.toolhead_filament_sensor_triggered():
-            self.unload_tool(-1, False)
+            if not self.unload_tool(-1, False):
+                return
+        self.save_state()
 
     def cmd_EJECT_TOOL(self, param):
         tool = param.get_int('TOOL', None, minval=-1, maxval=self.tool_count)
-        self.eject_filament(tool)
+        self.save_state(True)
+        if self.eject_filament(tool, False):
+            self.save_state()
 
     def cmd_HOME_ROME(self, param):
         self.Homed = False
+        self.save_state(True)
         if not self.home():
             self.respond("Can not home ROME!")
+            return
+        self.save_state()
 
     def cmd_CHANGE_TOOL(self, param):
         tool = param.get_int('TOOL', None, minval=0, maxval=self.tool_count)
+        self.save_state(True)
         if not self.change_tool(tool):
             self.pause_rome()
+            return
+        self.save_state()
 
     def cmd_ROME_END_PRINT(self, param):
         self.cmd_origin = "gcode"
-        self.infinite_spool = False
-        self.gcode.run_script_from_command("END_PRINT")
+        self.infinite_spool = self.infinite_spool_default
+        self.unstage_tool()
+        self.run_gcode("END_PRINT")
+        parked = False
         if self.unload_filament_after_print == 1:
+            parked = True
             if self.toolhead_filament_sensor_triggered():
-                self.unload_tool(-1, False)
+                parked = self.unload_tool(-1, False)
             if self.use_filament_caching:
-                self.uncache_all()
-            self.gcode.run_script_from_command('M84')
-        self.Homed = False
+                parked = self.uncache_all() and parked
+            parked = parked and not self.toolhead_filament_sensor_triggered()
+            self.run_gcode('M84')
+
+            # the motors are off, the idlers are homed again before their next move
+            for unit in range(len(self.Unit_Idler_Positions)):
+                self.Unit_Idler_Positions[unit] = None
+
+        # every filament is back in its parking position, the next print can stage its first tool without homing
+        self.Homed = self.Homed and parked
+        self.save_state()
+
+    def cmd_ROME_CANCEL_PRINT(self, param):
+        # a print cancelled while heating leaves the first tool staged
+        self.infinite_spool = self.infinite_spool_default
+        self.unstage_tool()
+        self.save_state()
 
     def cmd_ROME_START_PRINT(self, param):
         self.cmd_origin = "rome"
         self.mode = "native"
-        self.infinite_spool = False
+
+        # infinite spool has to be known before the filaments of the job are checked and the first tool is planned,
+        # SET_INFINITE_SPOOL between prints is kept, ROME_END_PRINT resets it to the configured default
+        self.infinite_spool = param.get_int('INFINITE_SPOOL', 1 if self.infinite_spool else 0, minval=0, maxval=1) == 1
         self.Filament_Changes = 0
         self.exchange_old_position = None
 
@@ -206,6 +485,12 @@ class ROME:
         for i in range(1, self.tool_count + 1):
             self.Filament_Cache.append(False)
 
+        self.Tool_Mapping = {}
+        for i in range(0, self.tool_count):
+            self.Filament_Usage[i] = 0.
+        self.Planned_Changes = None
+        self.Slicer_Tool = -1
+
         self.wipe_tower_x = param.get_float('WIPE_TOWER_X', None, minval=0, maxval=999) 
         self.wipe_tower_y = param.get_float('WIPE_TOWER_Y', None, minval=0, maxval=999)
         self.wipe_tower_width = param.get_float('WIPE_TOWER_WIDTH', None, minval=0, maxval=999)
@@ -224,12 +509,38 @@ class ROME:
         bed_temp = param.get_int('BED_TEMP', None, minval=-1, maxval=self.heater.max_temp)
         extruder_temp = param.get_int('EXTRUDER_TEMP', None, minval=-1, maxval=self.heater.max_temp)
         chamber_temp = param.get_int('CHAMBER_TEMP', None, minval=0, maxval=70)
+        tools = param.get('TOOLS', str(tool))
+
+        # check that every tool of the job has filament before heating up
+        missing_filaments = self.get_missing_filaments(tools)
+        if len(missing_filaments) > 0:
+            raise self.gcode.error("Filament " + ", ".join([str(f) for f in missing_filaments]) + " not present, please insert the filament and restart the print.")
 
         self.disable_toolhead_filament_sensor()
 
-        self.gcode.run_script_from_command("SET_GCODE_VARIABLE MACRO=RatOS VARIABLE=relative_extrusion VALUE=True")
-        self.gcode.run_script_from_command("SET_GCODE_VARIABLE MACRO=_START_PRINT_AFTER_HEATING_EXTRUDER VARIABLE=tool VALUE=" + str(tool + 1))
-        self.gcode.run_script_from_command("START_PRINT BED_TEMP=" + str(bed_temp) + " EXTRUDER_TEMP=" + str(extruder_temp) + " CHAMBER_TEMP=" + str(chamber_temp))
+        # temperatures of the job, one per slicer tool
+        self.Print_Tool_Temperatures = None
+        tool_temperatures = param.get('TOOL_TEMPS', '')
+        if tool_temperatures != '':
+            self.Print_Tool_Temperatures = [tool_temperature[0] for tool_temperature in self.parse_lists(tool_temperatures, self.gcode.error)]
+
+        # purge volumes of the wipe tower of the job, the wiping_volumes_matrix of the slicer
+        self.Print_Purge_Matrix = self.parse_purge_matrix(param.get('PURGE_MATRIX', ''), self.gcode.error)
+
+        # tool sequence of the job for the remaining change time
+        sequence = param.get('SEQUENCE', None)
+        if sequence is not None:
+            self.Planned_Changes = self.plan_tool_changes(self.parse_sequence(sequence), -1, [False] * self.tool_count)[1:]
+
+        # feed the first tool through the bowden while the printer heats up
+        self.Slicer_Tool = tool + 1
+        first_tool = self.get_planned_tool(tool + 1)
+        if self.stage_first_tool:
+            self.stage_tool(first_tool)
+
+        self.run_gcode("SET_GCODE_VARIABLE MACRO=RatOS VARIABLE=relative_extrusion VALUE=True")
+        self.run_gcode("SET_GCODE_VARIABLE MACRO=_START_PRINT_AFTER_HEATING_EXTRUDER VARIABLE=tool VALUE=" + str(first_tool))
+        self.run_gcode("START_PRINT BED_TEMP=" + str(bed_temp) + " EXTRUDER_TEMP=" + str(extruder_temp) + " CHAMBER_TEMP=" + str(chamber_temp))
 
     def cmd_ROME_INSERT_GCODE(self, param):
         self.insert_gcode()
@@ -238,13 +549,25 @@ class ROME:
         self.runout_gcode()
 
     def cmd_LOAD_FILAMENTS(self, param):
+        self.save_state(True)
         if not self.Homed:
             if not self.home():
                 return False
         if not self.home_filaments():
             return False
+        self.save_state()
         return True
 
+    def cmd_SCAN_FILAMENTS(self, param):
+        filament_present = self.scan_filaments()
+        for i in range(1, self.tool_count + 1):
+            if filament_present[i - 1] is None:
+                self.respond("Filament " + str(i) + ": no sensor")
+            elif filament_present[i - 1]:
+                self.respond("Filament " + str(i) + ": present")
+            else:
+                self.respond("Filament " + str(i) + ": empty")
+
     def cmd_Z_HOME_TEST(self, param):
         if not self.Homed:
             if not self.home():
@@ -255,18 +578,32 @@ class ROME:
 
     def cmd_F_INSERT(self, param):
         tool = param.get_int('TOOL', None, minval=0, maxval=self.tool_count)
+        self.save_state(True)
         if self.filament_insert(tool):
-            self.gcode.run_script_from_command('_AUTOLOAD_RESUME_AFTER_INSERT TOOL=' + str(tool))
+            self.save_state()
+            self.run_gcode('_AUTOLOAD_RESUME_AFTER_INSERT TOOL=' + str(tool))
 
     def cmd_F_RUNOUT(self, param):
         tool = param.get_int('TOOL', None, minval=0, maxval=self.tool_count)
+        self.save_state(True)
         if self.filament_runout(tool):
-            self.gcode.run_script_from_command('_INFINITE_RESUME_AFTER_SWAP TOOL=' + str(tool))
+            self.save_state()
+            self.run_gcode('_INFINITE_RESUME_AFTER_SWAP TOOL=' + str(tool))
 
     def cmd_SET_INFINITE_SPOOL(self, param):
         self.infinite_spool = not self.infinite_spool
         self.respond("Infinite Spool: " + str(self.infinite_spool))
 
+    def cmd_SET_SPOOL_LENGTH(self, param):
+        tool = param.get_int('TOOL', None, minval=1, maxval=self.tool_count)
+        length = param.get_float('LENGTH', None, minval=-1.)
+        if length < 0:
+            self.Spool_Remaining[tool - 1] = None
+        else:
+            self.Spool_Remaining[tool - 1] = length
+        self.save_state()
+        self.respond("Spool " + str(tool) + " remaining: " + str(self.Spool_Remaining[tool - 1]))
+
     # -----------------------------------------------------------------------------------------------------------------------------
     # Home
     # -----------------------------------------------------------------------------------------------------------------------------
@@ -276,6 +613,7 @@ class ROME:
 
         # homing rome
         self.respond("Homing Rome!")
+        self.unstage_tool()
         self.Homed = False
         self.Paused = False
 
@@ -326,6 +664,13 @@ class ROME:
         # success
         return True
 
+    def home_filament(self, filament):
+        if self.rome_setup == 0:
+            return self.home_extruder_filament(filament)
+        elif self.rome_setup == 1:
+            return self.home_mmu_splitter_filament(filament)
+        return False
+
     def home_filaments(self):
      
         # home filaments
@@ -351,7 +696,11 @@ class ROME:
     def home_extruder_filaments(self):
          
         # home all filaments
+        filament_present = self.scan_filaments()
         for i in range(1, self.tool_count + 1):
+            if filament_present[i - 1] == False:
+                self.respond("Filament " + str(i) + " not present, skipping")
+                continue
             if not self.home_extruder_filament(i):
                 return False
 
@@ -379,38 +728,47 @@ class ROME:
     # -----------------------------------------------------------------------------------------------------------------------------
     idler_selecting_speed = 125
     idler_selecting_accel = 80
-    idler_home_position = 85
     idler_homeing_speed = 40
     idler_homeing_accel = 40
-    idler_positions = [5,20,35,50,65]
 
     def home_mmu_splitter(self):
         
-        # home idler
-        self.home_idler()
+        # home idlers
+        for unit in range(len(self.Unit_Idlers)):
+            self.home_idler(unit)
 
         # success
         return True
 
-    def home_idler(self):
+    def home_idler(self, unit):
         home_current = 0.1
-        driver_status = self.stepper_driver_status('idler_stepper')
-        self.gcode.run_script_from_command('SET_TMC_CURRENT STEPPER=idler_stepper CURRENT=' + str(home_current) + ' HOLDCURRENT=' + str(home_current))
-        self.idler_stepper.do_set_position(0.0)
-        self.stepper_move(self.idler_stepper, 7, True, self.idler_homeing_speed, self.idler_homeing_accel)
-        self.stepper_homing_move(self.idler_stepper, -95, True, self.idler_homeing_speed, self.idler_homeing_accel, 1)
-        self.idler_stepper.do_set_position(2.0)
-        self.stepper_move(self.idler_stepper, self.idler_home_position, True, self.idler_homeing_speed, self.idler_homeing_accel)
-        self.gcode.run_script_from_command('SET_TMC_CURRENT STEPPER=idler_stepper CURRENT=' + str(driver_status['run_current']) + ' HOLDCURRENT=' + str(driver_status['hold_current']))
+        idler_name = self.Unit_Idler_Names[unit]
+        idler_stepper = self.Unit_Idlers[unit]
+        driver_status = self.stepper_driver_status(idler_name)
+        self.run_gcode('SET_TMC_CURRENT STEPPER=' + idler_name + ' CURRENT=' + str(home_current) + ' HOLDCURRENT=' + str(home_current))
+        idler_stepper.do_set_position(0.0)
+        self.stepper_move(idler_stepper, 7, True, self.idler_homeing_speed, self.idler_homeing_accel)
+        self.stepper_homing_move(idler_stepper, -self.idler_homing_travel_mm, True, self.idler_homeing_speed, self.idler_homeing_accel, 1)
+        idler_stepper.do_set_position(2.0)
+        self.stepper_move(idler_stepper, self.idler_home_position, True, self.idler_homeing_speed, self.idler_homeing_accel)
+        self.Unit_Idler_Positions[unit] = self.idler_home_position
+        self.run_gcode('SET_TMC_CURRENT STEPPER=' + idler_name + ' CURRENT=' + str(driver_status['run_current']) + ' HOLDCURRENT=' + str(driver_status['hold_current']))
 
     def home_mmu_splitter_filaments(self):
          
         # home all filaments
+        filament_present = self.scan_filaments()
         for i in range(1, self.tool_count + 1):
+            if filament_present[i - 1] == False:
+                self.respond("Filament " + str(i) + " not present, skipping")
+                continue
             if not self.home_mmu_splitter_filament(i):
                 self.respond("could not home filaments!")
                 return False
 
+        # release idlers
+        self.select_idler(-1)
+
         # success
         return True
 
@@ -420,9 +778,9 @@ class ROME:
         self.select_tool(filament)
 
         # home filament
-        self.gcode.run_script_from_command('G92 E0')
-        self.gcode.run_script_from_command('G0 E100 F' + str(self.filament_homing_speed_mms * 60))
-        self.gcode.run_script_from_command('M400')
+        if not self.filament_move(100, self.filament_homing_speed_mms):
+            self.respond("filament " + str(filament) + " jammed!")
+            return False
         if not self.y_filament_sensor_triggered():
             self.respond("filament " + str(filament) + " not found!")
             return True
@@ -435,6 +793,37 @@ class ROME:
         # success
         return True
 
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Filament Presence
+    # -----------------------------------------------------------------------------------------------------------------------------
+    def scan_filaments(self):
+        # reads all feeder sensors without any motion, None means there is no sensor for this filament
+        filament_present = []
+        for i in range(1, self.tool_count + 1):
+            if self.Lane_Feeder_Sensors[i - 1] is not None:
+                filament_present.append(bool(self.Lane_Feeder_Sensors[i - 1].runout_helper.filament_present))
+            else:
+                filament_present.append(None)
+        return filament_present
+
+    def get_missing_filaments(self, tools):
+        filament_present = self.scan_filaments()
+        missing_filaments = []
+        for tool in self.parse_lists(tools, self.gcode.error):
+            filament = self.get_mapped_tool(tool[0] + 1)
+            if filament < 1 or filament > self.tool_count:
+                continue
+            if filament_present[filament - 1] == False:
+                backup_tool = self.get_backup_tool(filament)
+                if backup_tool >= 0 and filament_present[backup_tool - 1] != False:
+                    if self.infinite_spool == True:
+                        self.respond("Filament " + str(filament) + " not present, using filament " + str(backup_tool))
+                        self.map_tool(filament, backup_tool)
+                        continue
+                    self.respond("Filament " + str(filament) + " could use backup filament " + str(backup_tool) + " with INFINITE_SPOOL=1")
+                missing_filaments.append(filament)
+        return missing_filaments
+
     # -----------------------------------------------------------------------------------------------------------------------------
     # Autoload
     # -----------------------------------------------------------------------------------------------------------------------------
@@ -445,21 +834,26 @@ class ROME:
 
         if self.rome_setup == 0:
 
-            # check hotend temperature
-            if not self.extruder_can_extrude():
-                self.respond("Hotend too cold!")
-                self.respond("Heating up nozzle to " + str(self.heater.min_extrude_temp))
-                self.extruder_set_temperature(self.heater.min_extrude_temp, True)
+            # move filament to the caching position, an idle lane is fed on its own motion queue
+            if self.is_lane_idle(tool):
+                self.start_lane_move(tool, self.get_bowden_parking_mm(tool), self.finish_filament_insert)
+                if self.runout_detected != True:
+                    return False
+                if self.wait_lane_move(tool) != 'distance':
+                    return False
+            else:
 
-            # select filament
-            self.select_tool(tool)
+                # check hotend temperature
+                if not self.extruder_can_extrude():
+                    self.respond("Hotend too cold!")
+                    self.respond("Heating up nozzle to " + str(self.heater.min_extrude_temp))
+                    self.extruder_set_temperature(self.heater.min_extrude_temp, True)
 
-            # move filament to the caching position
-            self.gcode.run_script_from_command('G92 E0')
-            self.gcode.run_script_from_command('G0 E50 F1000')
-            self.gcode.run_script_from_command('G92 E0')
-            self.gcode.run_script_from_command('G0 E' + str(self.toolhead_sensor_to_bowden_parking_mm - 50) + ' F' + str(self.filament_homing_speed_mms * 60))
-            self.gcode.run_script_from_command('M400')
+                # select filament
+                self.select_tool(tool)
+                self.run_gcode('G92 E0')
+                self.run_gcode('G0 E' + str(self.get_bowden_parking_mm(tool)) + ' F' + str(self.filament_homing_speed_mms * 60))
+                self.run_gcode('M400')
 
             # load filament to nozzle
             if self.runout_detected == True:
@@ -469,16 +863,25 @@ class ROME:
                 # load tool
                 if not self.load_tool(tool, -1, True):
                     # send notification
-                    self.gcode.run_script_from_command('_EXTRUDER_ERROR EXTRUDER=' + str(tool))
+                    self.run_gcode('_EXTRUDER_ERROR EXTRUDER=' + str(tool))
                     self.respond("Autoload failed, please insert filament " + str(tool) + " and resume the print.")
                     return False
 
                 return True
         return False
 
-    def eject_filament(self, tool):
+    def eject_filament(self, tool, wait=True):
         logging.info("eject filament " + str(tool))
         self.respond("eject filament " + str(tool))
+        if self.Staged_Tool == tool:
+            self.unstage_tool()
+
+        # eject an idle lane on its own motion queue, the active tool keeps printing
+        if self.rome_setup == 0 and self.is_lane_idle(tool):
+            self.start_lane_move(tool, -(self.get_bowden_parking_mm(tool) + 100), self.finish_filament_eject)
+            if wait:
+                return self.is_lane_ejected(tool, self.wait_lane_move(tool))
+            return True
 
         # check hotend temperature
         if not self.extruder_can_extrude():
@@ -491,20 +894,60 @@ class ROME:
             self.select_tool(tool)
 
             # eject filament
-            self.gcode.run_script_from_command('G92 E0')
-            self.gcode.run_script_from_command('G0 E-' + str(self.toolhead_sensor_to_bowden_parking_mm + 100) + ' F' + str(self.filament_homing_speed_mms * 60))
-            self.gcode.run_script_from_command('M400')
+            if not self.filament_move(-(self.get_bowden_parking_mm(tool) + 100), self.filament_homing_speed_mms):
+                self.respond("could not eject filament " + str(tool) + "!")
+                return False
 
             # success
             return True
 
         return False
 
+    def eject_filaments(self, tools):
+
+        # the splitter has a single pulley, eject one filament after the other
+        if self.rome_setup != 0 or len(tools) < 2:
+            results = {}
+            for tool in tools:
+                results[tool] = self.eject_filament(tool)
+            return results
+
+        logging.info("eject filaments " + str(tools))
+        self.respond("eject filaments " + str(tools))
+        if self.Staged_Tool in tools:
+            self.unstage_tool()
+
+        # idle lanes move on their own motion queues at the same time, the extruder is not touched
+        results = {}
+        idle_tools = []
+        for tool in tools:
+            if self.is_lane_idle(tool):
+                self.start_lane_move(tool, -(self.get_bowden_parking_mm(tool) + 100), self.finish_filament_eject)
+                idle_tools.append(tool)
+        for tool in tools:
+            if tool not in idle_tools:
+                results[tool] = self.eject_filament(tool)
+        for tool in idle_tools:
+            results[tool] = self.is_lane_ejected(tool, self.wait_lane_move(tool))
+        return results
+
     def filament_runout(self, tool):
         logging.info("runout detected filament " + str(tool))
         self.respond("runout detected filament " + str(tool))
+        self.count_statistic('runouts')
+
+        self.cmd_origin = "gcode"
+        self.Spool_Remaining[tool - 1] = 0.
+
+        # find backup spool
+        backup_tool = -1
+        if self.infinite_spool == True:
+            backup_tool = self.get_backup_tool(tool)
+            if backup_tool < 0:
+                self.respond("No backup spool for filament " + str(tool) + "!")
 
         # unload tool
+        prefed = False
         if self.Selected_Filament == tool:
             self.runout_detected = True
 
@@ -512,27 +955,274 @@ class ROME:
                 self.respond("could not unload tool!")
                 return False
 
-            self.eject_filament(tool)
+            # eject the empty filament while the backup filament is fed
+            if backup_tool >= 0 and self.can_eject_and_prefeed(tool, backup_tool):
+                if not self.eject_and_prefeed_filament(tool, backup_tool):
+                    return False
+                prefed = True
+            else:
+                self.eject_filament(tool)
         
-        if self.infinite_spool == True:
+        if backup_tool >= 0:
 
-            if tool == 1:
-                tool = 2
-            elif tool == 2:
-                tool = 1
+            self.map_tool(tool, backup_tool)
+            tool = backup_tool
         
             self.select_tool(tool)
 
             # load tool
-            if not self.load_tool(tool, -1, True):
+            if not self.load_tool(tool, -1, True, prefed):
                 # send notification
-                self.gcode.run_script_from_command('_EXTRUDER_ERROR EXTRUDER=' + str(tool))
+                self.run_gcode('_EXTRUDER_ERROR EXTRUDER=' + str(tool))
                 self.respond("Autload failed, please insert filament " + str(tool) + " and resume the print.")
                 return False
 
             return True
         return False
 
+    def can_eject_and_prefeed(self, eject_tool, feed_tool):
+        if self.rome_setup != 0:
+            return False
+        if self.is_cache_blocked(feed_tool) >= 0 or self.is_filament_cached(feed_tool):
+            return False
+        return True
+
+    def eject_and_prefeed_filament(self, eject_tool, feed_tool):
+        logging.info("eject filament " + str(eject_tool) + " and prefeed filament " + str(feed_tool))
+        self.respond("eject filament " + str(eject_tool) + " and prefeed filament " + str(feed_tool))
+
+        # eject and prefeed
+        distances = {}
+        distances[eject_tool] = -(self.get_bowden_parking_mm(eject_tool) + 100)
+        distances[feed_tool] = self.get_bowden_cache_mm(feed_tool)
+        if not self.filament_move_extruder_feeders(distances, self.filament_homing_speed_mms):
+            self.respond("could not eject filament " + str(eject_tool) + "!")
+            return False
+
+        # success
+        return True
+
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Lane Motion
+    # -----------------------------------------------------------------------------------------------------------------------------
+    lane_move_interval = 0.05
+    lane_move_chunk_time = 0.1
+    lane_move_lead_time = 0.25
+    lane_move_toolhead_margin = 1.0
+
+    def is_lane_idle(self, tool):
+        if tool < 1 or tool > self.tool_count or tool in self.Lane_Moves or tool in self.Synced_Tools:
+            return False
+        if self.Selected_Filament == tool and self.toolhead_filament_sensor_triggered():
+            return False
+        return self.get_lane_extruder_stepper(tool).motion_queue is None
+
+    def get_lane_extruder_stepper(self, tool):
+        if self.rome_setup == 1:
+            return self.printer.lookup_object('extruder_stepper ' + self.Unit_Pulley_Names[self.get_lane_unit(tool)]).extruder_stepper
+        return self.printer.lookup_object('extruder_stepper ' + self.get_lane_extruder(tool)).extruder_stepper
+
+    def start_lane_move(self, tool, distance, callback=None):
+
+        # the lane stepper gets its own trapq, the extruder and the active lane are not touched
+        ffi_main, ffi_lib = chelper.get_ffi()
+        stepper = self.get_lane_extruder_stepper(tool).stepper
+        trapq = ffi_main.gc(ffi_lib.trapq_alloc(), ffi_lib.trapq_free)
+        stepper.set_position([0., 0., 0.])
+        stepper.set_trapq(trapq)
+        lane_move = {
+            'tool': tool,
+            'stepper': stepper,
+            'trapq': trapq,
+            'direction': 1. if distance > 0 else -1.,
+            'remaining': abs(distance),
+            'position': 0.,
+            'velocity': 0.,
+            'speed': self.filament_homing_speed_mms,
+            'accel': self.extruder.max_e_accel,
+            'move_time': 0.,
+            'end_time': None,
+            'result': None,
+            'callback': callback
+        }
+        self.Lane_Moves[tool] = lane_move
+        lane_move['timer'] = self.reactor.register_timer(lambda eventtime: self.lane_move_handler(lane_move, eventtime), self.reactor.NOW)
+
+    def lane_move_handler(self, lane_move, eventtime):
+        print_time = self.mcu.estimated_print_time(eventtime)
+
+        # wait until the last queued segment has been executed
+        if lane_move['end_time'] is not None:
+            if print_time < lane_move['end_time']:
+                return eventtime + self.lane_move_interval
+            self.finish_lane_move(lane_move)
+            return self.reactor.NEVER
+
+        # a feeder sensor that lost the filament ends the move
+        feeder_sensor = self.Lane_Feeder_Sensors[lane_move['tool'] - 1]
+        if feeder_sensor is not None and not feeder_sensor.runout_helper.filament_present:
+            lane_move['result'] = 'sensor'
+            self.queue_lane_stop(lane_move, print_time)
+            return eventtime + self.lane_move_interval
+
+        # the toolhead generates the steps of all steppers up to the moves it commits, the
+        # queued segments have to stay ahead of its print time so that none of them is skipped
+        queue_time = max(print_time + self.lane_move_lead_time, self.toolhead.get_status(eventtime)['print_time'] + self.lane_move_toolhead_margin)
+        lane_move['move_time'] = max(lane_move['move_time'], queue_time - self.lane_move_chunk_time)
+        while lane_move['move_time'] < queue_time:
+            speed = lane_move['speed']
+            accel = lane_move['accel']
+            velocity = lane_move['velocity']
+            stop_distance = velocity * velocity / (2. * accel)
+            if lane_move['remaining'] - stop_distance <= 0.001:
+                lane_move['result'] = 'distance'
+                self.queue_lane_stop(lane_move, print_time)
+                break
+            if velocity < speed:
+                accel_t = (speed - velocity) / accel
+                distance = (velocity + speed) * .5 * accel_t
+                if distance + speed * speed / (2. * accel) > lane_move['remaining']:
+                    # too short to reach full speed
+                    lane_move['result'] = 'distance'
+                    self.queue_lane_stop(lane_move, print_time, True)
+                    break
+                self.queue_lane_segment(lane_move, accel_t, 0., 0., velocity, speed)
+                lane_move['velocity'] = speed
+            else:
+                cruise_t = min(self.lane_move_chunk_time, (lane_move['remaining'] - stop_distance) / speed)
+                self.queue_lane_segment(lane_move, 0., cruise_t, 0., speed, speed)
+        return eventtime + self.lane_move_interval
+
+    def queue_lane_segment(self, lane_move, accel_t, cruise_t, decel_t, start_v, cruise_v):
+        ffi_main, ffi_lib = chelper.get_ffi()
+        distance = (start_v + cruise_v) * .5 * accel_t + cruise_v * cruise_t + cruise_v * .5 * decel_t
+        ffi_lib.trapq_append(lane_move['trapq'], lane_move['move_time'], accel_t, cruise_t, decel_t, lane_move['position'], 0., 0., lane_move['direction'], 0., 0., start_v, cruise_v, lane_move['accel'])
+        lane_move['move_time'] = lane_move['move_time'] + accel_t + cruise_t + decel_t
+        lane_move['position'] = lane_move['position'] + lane_move['direction'] * distance
+        lane_move['remaining'] = lane_move['remaining'] - distance
+
+        # generate the steps right away, like a manual stepper move
+        lane_move['stepper'].generate_steps(lane_move['move_time'])
+        ffi_lib.trapq_finalize_moves(lane_move['trapq'], lane_move['move_time'] + 99999.9, lane_move['move_time'] + 99999.9)
+        self.toolhead.note_mcu_movequeue_activity(lane_move['move_time'])
+
+    def queue_lane_stop(self, lane_move, print_time, triangle=False):
+        accel = lane_move['accel']
+        velocity = lane_move['velocity']
+        lane_move['move_time'] = max(lane_move['move_time'], print_time + self.lane_move_lead_time)
+        if triangle:
+            # accelerate as far as the remaining distance allows and stop again
+            peak_v = sqrt(velocity * velocity * .5 + accel * lane_move['remaining'])
+            self.queue_lane_segment(lane_move, (peak_v - velocity) / accel, 0., peak_v / accel, velocity, peak_v)
+        elif velocity > 0.:
+            self.queue_lane_segment(lane_move, 0., 0., velocity / accel, velocity, velocity)
+        lane_move['velocity'] = 0.
+        lane_move['end_time'] = lane_move['move_time']
+
+    def finish_lane_move(self, lane_move):
+        self.reactor.unregister_timer(lane_move['timer'])
+        lane_move['stepper'].set_trapq(None)
+        del self.Lane_Moves[lane_move['tool']]
+        if lane_move['callback'] is not None:
+            lane_move['callback'](lane_move['tool'], lane_move['result'])
+
+    def wait_lane_move(self, tool):
+        lane_move = self.Lane_Moves.get(tool)
+        if lane_move is None:
+            return None
+        eventtime = self.reactor.monotonic()
+        while tool in self.Lane_Moves:
+            eventtime = self.reactor.pause(eventtime + self.lane_move_interval)
+        return lane_move['result']
+
+    def get_staging_distance(self, tool):
+        # the initial move of the bowden load, the sensor search starts behind it
+        if self.rome_setup == 0:
+            return self.get_bowden_cache_mm(tool)
+        return self.get_bowden_parking_mm(tool)
+
+    def stage_tool(self, tool):
+
+        # the lane or pulley moves on its own motion queue, this is safe with a cold hotend
+        if tool < 1 or tool > self.tool_count or not self.Homed or self.toolhead_filament_sensor_triggered():
+            return False
+
+        # a tool staged by a cancelled print is already in the bowden
+        if self.Staged_Tool is not None:
+            return False
+
+        # the parking position is only known while the feeder sensor sees the filament
+        feeder_sensor = self.Lane_Feeder_Sensors[tool - 1]
+        if feeder_sensor is not None and not feeder_sensor.runout_helper.filament_present:
+            return False
+
+        # a cached filament, or one that has to evict a cached filament first, is loaded the normal way
+        if self.use_filament_caching == True and self.tool_count > 2:
+            if self.is_filament_cached(tool) or self.is_cache_blocked(tool) >= 0:
+                return False
+
+        if self.rome_setup == 0:
+            if not self.is_lane_idle(tool):
+                return False
+        elif self.rome_setup == 1:
+            self.unsync_pulleys()
+            self.move_idler(self.get_lane_unit(tool), self.Lane_Idler_Positions[tool - 1])
+        else:
+            return False
+        self.respond("staging tool " + str(tool))
+        self.Staged_Tool = tool
+        self.save_state(True)
+        self.start_lane_move(tool, self.get_staging_distance(tool), self.finish_tool_stage_move)
+        return True
+
+    def finish_tool_stage_move(self, tool, result):
+        self.save_state()
+
+    def finish_tool_staging(self, tool):
+        staged_tool = self.Staged_Tool
+        if staged_tool == tool:
+            self.Staged_Tool = None
+            self.wait_lane_move(staged_tool)
+            return True
+
+        # another tool is loaded
+        self.unstage_tool()
+        return False
+
+    def unstage_tool(self):
+        # move the staged filament back to its parking position
+        staged_tool = self.Staged_Tool
+        if staged_tool is None:
+            return
+        self.Staged_Tool = None
+        self.wait_lane_move(staged_tool)
+        self.respond("unstaging tool " + str(staged_tool))
+        if self.rome_setup == 1:
+            self.unsync_pulleys()
+            self.move_idler(self.get_lane_unit(staged_tool), self.Lane_Idler_Positions[staged_tool - 1])
+        self.start_lane_move(staged_tool, -self.get_staging_distance(staged_tool))
+        self.wait_lane_move(staged_tool)
+
+    def finish_filament_insert(self, tool, result):
+        if result == 'distance':
+            self.respond("filament " + str(tool) + " inserted")
+        else:
+            self.respond("filament " + str(tool) + " removed while inserting!")
+        self.save_state()
+
+    def finish_filament_eject(self, tool, result):
+        if self.is_lane_ejected(tool, result):
+            self.respond("filament " + str(tool) + " ejected")
+        else:
+            self.respond("could not eject filament " + str(tool) + "!")
+        self.save_state()
+
+    def is_lane_ejected(self, tool, result):
+        # the feeder sensor has to clear, a lane without one can only move the full distance
+        if self.Lane_Feeder_Sensors[tool - 1] is None:
+            return result == 'distance'
+        return result == 'sensor'
+
     # -----------------------------------------------------------------------------------------------------------------------------
     # Change Tool
     # -----------------------------------------------------------------------------------------------------------------------------
@@ -555,51 +1245,103 @@ class ROME:
 
         # change tool
         if self.Filament_Changes > 0:
-            self.before_change()
-            if not self.load_tool(tool + 1, -1, self.use_filament_caching):
+            planned_tool = self.get_planned_tool(tool + 1)
+            if self.is_tool_loaded(planned_tool):
+                self.respond("tool " + str(planned_tool) + " already loaded")
+                self.count_statistic('skipped_changes')
+            else:
+                self.before_change()
+                self.Change_Slicer_Tool = tool + 1
+                if not self.timed_phase('change', self.load_tool, planned_tool, -1, self.use_filament_caching) and not self.recover_tool_change(planned_tool, -1, self.use_filament_caching):
+                    self.Change_Slicer_Tool = -1
 
-                # send notification
-                self.gcode.run_script_from_command('_EXTRUDER_ERROR EXTRUDER=' + str(tool))
+                    # send notification
+                    self.run_gcode('_EXTRUDER_ERROR EXTRUDER=' + str(tool))
 
-                return False
-            self.after_change()
+                    self.count_statistic('failures')
+                    return False
+                self.Change_Slicer_Tool = -1
+                self.count_statistic('changes')
+                self.after_change()
+        self.Slicer_Tool = tool + 1
         self.Filament_Changes = self.Filament_Changes + 1
 
         # success
         return True
 
-    def load_tool(self, tool, temp, cache):
+    Unload_Temperature = -1
+
+    def get_tool_temperature(self, tool):
+        # slicer tool temperatures of the print, then the configured lane temperatures
+        slicer_tool = self.get_loading_slicer_tool(tool)
+        if self.Print_Tool_Temperatures is not None and 1 <= slicer_tool <= len(self.Print_Tool_Temperatures):
+            return self.Print_Tool_Temperatures[slicer_tool - 1]
+        return self.Tool_Temperatures[tool - 1]
+
+    def get_loading_slicer_tool(self, tool):
+        # the slicer tool of a CHANGE_TOOL, or the first tool of the print that is mapped to this lane
+        if self.Change_Slicer_Tool >= 1:
+            return self.Change_Slicer_Tool
+        if self.Slicer_Tool >= 1 and self.get_mapped_tool(self.Slicer_Tool) == tool:
+            return self.Slicer_Tool
+        return -1
+
+    def is_tool_loaded(self, tool):
+        # in slicer mode the filament has already been rammed out of the nozzle
+        if self.mode == "slicer" or not self.Homed:
+            return False
+        return self.Selected_Filament == tool and self.toolhead_filament_sensor_triggered()
+
+    def load_tool(self, tool, temp, cache, prefed=False):
         logging.info("load_tool " + str(tool))
         self.respond("load_tool " + str(tool))
         
         # send notification
-        self.gcode.run_script_from_command('_SELECT_EXTRUDER EXTRUDER=' + str(tool))
+        self.run_gcode('_SELECT_EXTRUDER EXTRUDER=' + str(tool))
 
-        # set hotend temperature
+        # a tool staged during the print start only needs the sensor search
+        if self.Staged_Tool is not None:
+            if self.finish_tool_staging(tool):
+                prefed = True
+
+        # set hotend temperature, cooling down starts when the filament has left the nozzle
+        if temp <= 0:
+            temp = self.get_tool_temperature(tool)
+        self.Unload_Temperature = -1
         if temp > 0:
-            self.set_hotend_temperature(temp)
+            if temp >= self.get_target_temperature():
+                self.set_hotend_temperature(temp)
+            else:
+                self.Unload_Temperature = temp
 
         # home if not homed yet
         if not self.Homed:
             if not self.home():
                 return False
 
-        # set temp if configured and wait for it
-        if temp > 0:
-            self.respond("Waiting for heater...")
-            self.extruder_set_temperature(temp, True)
+            # homing unloads the nozzle and turns off the heater
+            if temp > 0:
+                self.set_hotend_temperature(temp)
+                self.Unload_Temperature = -1
 
         # check hotend temperature
         if not self.extruder_can_extrude():
             self.respond("Hotend too cold!")
             self.respond("Heat up nozzle to " + str(self.heater.min_extrude_temp))
-            self.extruder_set_temperature(self.heater.min_extrude_temp, True)
+            self.extruder_wait_for_extrude_temperature()
 
         # enable filament sensor
         self.enable_toolhead_filament_sensor()
 
         # load filament
+        previous_filament = -1
+        self.Failed_Phase = None
+        self.Recovery_Previous_Filament = -1
         if self.toolhead_filament_sensor_triggered():
+            previous_filament = self.Selected_Filament
+            self.Recovery_Previous_Filament = previous_filament
+            if self.rome_setup == 1:
+                self.preselect_idler(tool)
             if not self.unload_tool(tool, cache):
                 self.respond("could not unload tool!")
                 return False
@@ -607,50 +1349,81 @@ class ROME:
             if self.cmd_origin == "rome":
                 self.respond("Possible sensor failure!")
                 self.respond("Filament sensor should be triggered but it isnt!")
+                self.Failed_Phase = 'sensor_state'
                 return False
 
         self.select_tool(tool)
-        if not self.load_filament_from_reverse_bowden_to_toolhead_sensor():
+        return self.load_selected_tool(tool, temp, prefed, self.get_change_purge_length(previous_filament))
+
+    def load_selected_tool(self, tool, temp, prefed, purge_length):
+        self.Phase_Estimates = self.estimate_load(tool, list(self.Filament_Cache), self.Filament_Changes == 0, purge_length)[0]
+        if not self.timed_phase('load_bowden', self.load_filament_from_reverse_bowden_to_toolhead_sensor, True, prefed):
             self.respond("could not load tool to sensor!")
             return False
-        if not self.load_filament_from_toolhead_sensor_to_parking_position():
+        if not self.timed_phase('load_parking', self.load_filament_from_toolhead_sensor_to_parking_position):
             return False
+        if self.Unload_Temperature > 0:
+            self.set_hotend_temperature(self.Unload_Temperature)
+            self.Unload_Temperature = -1
         if self.mode != "slicer" or self.Filament_Changes == 0:
-            if not self.load_filament_from_parking_position_to_nozzle():
+
+            # wait for the heater, the filament moves so far overlapped with heating
+            if temp > 0:
+                self.respond("Waiting for heater...")
+                self.timed_phase('heating', self.extruder_set_temperature, temp, True)
+
+            if not self.timed_phase('load_nozzle', self.load_filament_from_parking_position_to_nozzle, purge_length):
                 self.respond("could not load into nozzle!")
                 return False
 
         # success
+        self.count_statistic('loads')
+        self.start_usage_tracking(tool)
         self.respond("tool " + str(tool) + " loaded")
 
         # send notification
-        self.gcode.run_script_from_command('_EXTRUDER_SELECTED EXTRUDER=' + str(tool))
+        self.run_gcode('_EXTRUDER_SELECTED EXTRUDER=' + str(tool))
 
         return True
 
     def unload_tool(self, new_filament, cache):
+        self.unstage_tool()
+
+        # filament usage
+        self.stop_usage_tracking()
 
         # select tool
         self.select_tool(self.Selected_Filament)
+        self.Phase_Estimates = {}
+        if self.Selected_Filament >= 1:
+            self.Phase_Estimates = self.estimate_unload(self.Selected_Filament, new_filament, list(self.Filament_Cache), cache)[0]
 
         # unload tool
         if self.mode != "slicer":
-            if not self.unload_filament_from_nozzle_to_parking_position():
+            if not self.timed_phase('unload_nozzle', self.unload_filament_from_nozzle_to_parking_position):
                 return False
-        if not self.unload_filament_from_parking_position_to_toolhead_sensor():
+
+        # cool down for the next tool while the filament is unloaded
+        if self.Unload_Temperature > 0:
+            self.set_hotend_temperature(self.Unload_Temperature)
+            self.Unload_Temperature = -1
+
+        if not self.timed_phase('unload_parking', self.unload_filament_from_parking_position_to_toolhead_sensor):
             return False
-        if not self.unload_filament_from_toolhead_sensor(new_filament, cache):
+        if not self.timed_phase('unload_bowden', self.unload_filament_from_toolhead_sensor, new_filament, cache):
             return False
 
         # test if filament has been unloaded behind the y-sensor
         if not cache:
             if self.y_filament_sensor_triggered():
                 self.respond("Unload not completed!")
+                if self.Failed_Phase is None:
+                    self.Failed_Phase = 'unload_check'
                 return False
 
-        # release mmu splitter idler
-        if self.rome_setup == 1:
-            self.select_idler(-1)
+        # release mmu splitter idler, an idler preselected for the next lane stays in place
+        if self.rome_setup == 1 and self.Selected_Filament >= 1:
+            self.release_idler(self.get_lane_unit(self.Selected_Filament))
 
         # success
         return True
@@ -663,16 +1436,28 @@ class ROME:
         
     def after_change(self):
         self.disable_toolhead_filament_sensor()
+        self.restore_change_kinematic_profile()
 
         # send notification
-        self.gcode.run_script_from_command('_CONTINUE_PRINTING EXTRUDER=' + str(self.Selected_Filament))
+        self.run_gcode('_CONTINUE_PRINTING EXTRUDER=' + str(self.Selected_Filament))
 
     # -----------------------------------------------------------------------------------------------------------------------------
     # Rome Native
     # -----------------------------------------------------------------------------------------------------------------------------
 
     def before_change_rome_native(self):
-        self.gcode.run_script_from_command('SAVE_GCODE_STATE NAME=PAUSE_state')
+        self.run_gcode('SAVE_GCODE_STATE NAME=PAUSE_state')
+        self.set_exchange_position()
+
+        self.apply_change_kinematic_profile()
+        self.run_gcode('G92 E0')
+        self.run_gcode('G0 E-2 F3600')
+        self.run_gcode('M400')
+        
+    def is_ooze_ex_active(self):
+        return self.cmd_origin == "rome" and self.exchange_old_position != None and self.use_ooze_ex == 1
+
+    def set_exchange_position(self):
         self.exchange_old_position = self.toolhead.get_position()
 
         x_offset = abs(self.exchange_old_position[0] - self.wipe_tower_x)
@@ -681,25 +1466,128 @@ class ROME:
         else:
             self.ooze_move_x = self.exchange_old_position[0] - self.wipe_tower_width
 
-        self.gcode.run_script_from_command('M204 S' + str(self.wipe_tower_acceleration))
-        self.gcode.run_script_from_command('G92 E0')
-        self.gcode.run_script_from_command('G0 E-2 F3600')
-        self.gcode.run_script_from_command('M400')
-        
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Purge
+    # -----------------------------------------------------------------------------------------------------------------------------
+    def parse_purge_matrix(self, value, error):
+        # row major volumes in mm3, row = unloaded tool, column = loaded tool
+        if value.strip().strip('"') == '':
+            return None
+        try:
+            volumes = [float(volume) for volume in value.strip().strip('"').split(',')]
+        except ValueError:
+            raise error("Unable to parse purge matrix '" + value + "'")
+        size = int(round(sqrt(len(volumes))))
+        if size * size != len(volumes):
+            raise error("Purge matrix needs one volume for every tool pair")
+        purge_matrix = []
+        for i in range(size):
+            purge_matrix.append(volumes[i * size:(i + 1) * size])
+        return purge_matrix
+
+    def get_purge_length(self, from_tool, to_tool):
+        # slicer tools, the wipe tower already purges the volume of the print matrix, rome only purges what is missing
+        purge_volume = self.get_purge_volume(self.Purge_Matrix, from_tool, to_tool) - self.get_purge_volume(self.Print_Purge_Matrix, from_tool, to_tool)
+        return max(0., purge_volume) / self.extruder.filament_area
+
+    def get_purge_volume(self, purge_matrix, from_tool, to_tool):
+        if purge_matrix is None or from_tool == to_tool:
+            return 0.
+        if from_tool < 1 or from_tool > len(purge_matrix) or to_tool < 1 or to_tool > len(purge_matrix):
+            return 0.
+        return purge_matrix[from_tool - 1][to_tool - 1]
+
+    def get_change_purge_length(self, previous_filament):
+        # only tool changes of a print in native mode purge, the purge is spread over the ooze ex moves
+        if self.mode != "native" or previous_filament < 1 or not self.is_ooze_ex_active():
+            return 0.
+        return self.get_purge_length(self.Slicer_Tool, self.Change_Slicer_Tool)
+
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Kinematic Profiles
+    # -----------------------------------------------------------------------------------------------------------------------------
+    kinematic_profile_phases = ['change', 'unload_nozzle', 'unload_parking', 'unload_bowden', 'load_bowden', 'load_parking', 'load_nozzle']
+    kinematic_limit_names = ['velocity', 'accel', 'square_corner_velocity', 'extrude_velocity', 'extrude_accel']
+
+    def parse_kinematic_profile(self, option, value):
+        profile = {}
+        for item in value.split(','):
+            name, separator, limit = item.partition('=')
+            name = name.strip()
+            if name not in self.kinematic_limit_names or separator == '':
+                raise self.config.error("Unable to parse '" + item.strip() + "' in option '" + option + "', use " + "=<value>, ".join(self.kinematic_limit_names) + "=<value>")
+            try:
+                profile[name] = float(limit)
+            except ValueError:
+                raise self.config.error("Unable to parse '" + item.strip() + "' in option '" + option + "'")
+            if profile[name] <= 0.:
+                raise self.config.error("Option '" + option + "' needs positive limits")
+        return profile
+
+    def get_kinematic_profile(self, phase):
+        profile = self.Kinematic_Profiles.get((phase, self.Selected_Filament))
+        if profile is None:
+            profile = self.Kinematic_Profiles.get((phase, 0))
+        return profile
+
+    def get_kinematic_limits(self):
+        status = self.toolhead.get_status(self.reactor.monotonic())
+        limits = {
+            'velocity': status['max_velocity'],
+            'accel': status['max_accel'],
+            'square_corner_velocity': status['square_corner_velocity'],
+            'extrude_velocity': self.extruder.max_e_velocity,
+            'extrude_accel': self.extruder.max_e_accel
+        }
+
+        # the fourth toolhead limit depends on the klipper version
+        if 'minimum_cruise_ratio' in status:
+            limits['cruise'] = status['minimum_cruise_ratio']
+        else:
+            limits['cruise'] = status.get('max_accel_to_decel')
+        return limits
+
+    def set_kinematic_limits(self, limits):
+        self.toolhead.set_max_velocities(limits.get('velocity'), limits.get('accel'), limits.get('square_corner_velocity'), limits.get('cruise'))
+        if limits.get('extrude_velocity') is not None:
+            self.extruder.max_e_velocity = limits['extrude_velocity']
+        if limits.get('extrude_accel') is not None:
+            self.extruder.max_e_accel = limits['extrude_accel']
+
+    def apply_kinematic_profile(self, phase):
+        # returns the previous limits, None if the phase has no profile
+        profile = self.get_kinematic_profile(phase)
+        if profile is None:
+            return None
+        limits = self.get_kinematic_limits()
+        self.set_kinematic_limits(profile)
+        return limits
+
+    def apply_change_kinematic_profile(self):
+        if self.Saved_Kinematic_Limits is None:
+            self.Saved_Kinematic_Limits = self.apply_kinematic_profile('change')
+
+    def restore_change_kinematic_profile(self):
+        if self.Saved_Kinematic_Limits is not None:
+            self.set_kinematic_limits(self.Saved_Kinematic_Limits)
+            self.Saved_Kinematic_Limits = None
+
     # -----------------------------------------------------------------------------------------------------------------------------
     # Rome Slicer
     # -----------------------------------------------------------------------------------------------------------------------------
 
     def before_change_rome_slicer(self):
         self.respond("before_change_rome_slicer")
-        self.gcode.run_script_from_command('SAVE_GCODE_STATE NAME=PAUSE_state')
+        self.run_gcode('SAVE_GCODE_STATE NAME=PAUSE_state')
         self.exchange_old_position = self.toolhead.get_position()
-        self.gcode.run_script_from_command('M204 S' + str(self.wipe_tower_acceleration))
+        self.apply_change_kinematic_profile()
         
     # -----------------------------------------------------------------------------------------------------------------------------
     # Select Tool
     # -----------------------------------------------------------------------------------------------------------------------------
     Selected_Filament = -1
+    Synced_Tools = []
+    Synced_Pulley = None
 
     def select_tool(self, tool=-1):
         if tool == 0:
@@ -720,7 +1608,34 @@ class ROME:
         if tool != 0:
             for i in range(1, self.tool_count + 1):
                 if tool == i or tool == -1:
-                    self.gcode.run_script_from_command('SYNC_EXTRUDER_MOTION EXTRUDER=rome_extruder_' + str(i) + ' MOTION_QUEUE=extruder')
+                    self.wait_lane_move(i)
+                    self.run_gcode('SYNC_EXTRUDER_MOTION EXTRUDER=' + self.get_lane_extruder(i) + ' MOTION_QUEUE=extruder')
+                    self.Synced_Tools.append(i)
+
+    def select_tools_extruder_feeder(self, tools):
+        self.respond("selecting tools " + str(tools))
+        self.unselect_tool()
+        for tool in tools:
+            self.select_tool_extruder_feeder(tool)
+
+    def filament_move_extruder_feeders(self, distances, speed):
+
+        # all feeders are synced to the extruder, their rotation distances are scaled so that
+        # every feeder moves its own distance while the longest move sets the duration
+        move_distance = max([abs(distance) for distance in distances.values()])
+        rotation_distances = {}
+        for tool, distance in distances.items():
+            if distance != 0:
+                rotation_distances[tool] = self.get_rotation_distance(tool)
+                self.set_rotation_distance(tool, rotation_distances[tool] * move_distance / distance)
+        self.select_tools_extruder_feeder(sorted(rotation_distances.keys()))
+        success = self.filament_move(move_distance, speed)
+
+        # restore feeders
+        self.unselect_tool()
+        for tool, rotation_distance in rotation_distances.items():
+            self.set_rotation_distance(tool, rotation_distance)
+        return success
 
     def select_tool_mmu_splitter(self, tool):
         self.select_idler(tool)
@@ -733,30 +1648,70 @@ class ROME:
 
     def unselect_tool_extruder_feeder(self):
         self.Selected_Filament = -1
+        self.Synced_Tools = []
         for i in range(1, self.tool_count + 1):
-            self.gcode.run_script_from_command('SYNC_EXTRUDER_MOTION EXTRUDER=rome_extruder_' + str(i) + ' MOTION_QUEUE=')
+            # a lane that is moved on its own motion queue is not synced
+            if i not in self.Lane_Moves:
+                self.run_gcode('SYNC_EXTRUDER_MOTION EXTRUDER=' + self.get_lane_extruder(i) + ' MOTION_QUEUE=')
 
     def unselect_tool_mmu_splitter(self):
-        self.select_idler(-1)
+        # the idlers stay in place, selecting the next lane moves them directly
+        self.unsync_pulleys()
 
     def select_idler(self, tool):
-        if tool >= 0:
-            self.stepper_move(self.idler_stepper, self.idler_positions[tool - 1], True, self.idler_selecting_speed, self.idler_selecting_accel)
-            self.gcode.run_script_from_command('SYNC_EXTRUDER_MOTION EXTRUDER=pulley_extruder MOTION_QUEUE=extruder')
+        if tool >= 1:
+            unit = self.get_lane_unit(tool)
+            self.unsync_pulleys()
+            self.move_idler(unit, self.Lane_Idler_Positions[tool - 1])
+            self.run_gcode('SYNC_EXTRUDER_MOTION EXTRUDER=' + self.Unit_Pulley_Names[unit] + ' MOTION_QUEUE=extruder')
+            self.Synced_Pulley = self.Unit_Pulley_Names[unit]
+        else:
+            self.unsync_pulleys()
+            for unit in range(len(self.Unit_Idlers)):
+                self.move_idler(unit, self.idler_home_position)
+
+    def release_idler(self, unit):
+        self.unsync_pulleys()
+        self.move_idler(unit, self.idler_home_position)
+
+    def preselect_idler(self, tool):
+        # an idle unit moves its idler to the next lane while the active unit unloads
+        if tool < 1 or self.Selected_Filament < 1:
+            return
+        unit = self.get_lane_unit(tool)
+        if unit != self.get_lane_unit(self.Selected_Filament):
+            self.move_idler(unit, self.Lane_Idler_Positions[tool - 1], False)
+
+    def move_idler(self, unit, position, wait=True):
+        idler_stepper = self.Unit_Idlers[unit]
+        if self.Unit_Idler_Positions[unit] is None:
+            self.home_idler(unit)
+        if self.Unit_Idler_Positions[unit] != position:
+            self.stepper_move(idler_stepper, position, False, self.idler_selecting_speed, self.idler_selecting_accel, False)
+            self.Unit_Idler_Positions[unit] = position
+
+        # following filament moves are queued after the idler move, the host does not wait
+        if wait:
+            idler_stepper.sync_print_time()
+
+    def unsync_pulleys(self):
+        if not self.Synced_Pulley:
+            for pulley_name in self.Unit_Pulley_Names:
+                self.run_gcode('SYNC_EXTRUDER_MOTION EXTRUDER=' + pulley_name + ' MOTION_QUEUE=')
         else:
-            self.stepper_move(self.idler_stepper, self.idler_home_position, True, self.idler_selecting_speed, self.idler_selecting_accel)
-            self.gcode.run_script_from_command('SYNC_EXTRUDER_MOTION EXTRUDER=pulley_extruder MOTION_QUEUE=')
+            self.run_gcode('SYNC_EXTRUDER_MOTION EXTRUDER=' + self.Synced_Pulley + ' MOTION_QUEUE=')
+        self.Synced_Pulley = None
 
     # -----------------------------------------------------------------------------------------------------------------------------
     # Load Filament
     # -----------------------------------------------------------------------------------------------------------------------------
-    def load_filament_from_reverse_bowden_to_toolhead_sensor(self, exact_positioning=True):
+    def load_filament_from_reverse_bowden_to_toolhead_sensor(self, exact_positioning=True, prefed=False):
         self.respond("load_filament_from_reverse_bowden_to_toolhead_sensor")
 
         # set load distance
-        load_distance = self.toolhead_sensor_to_bowden_parking_mm
+        load_distance = self.get_bowden_parking_mm(self.Selected_Filament)
         if self.rome_setup == 0:
-            load_distance = self.toolhead_sensor_to_bowden_cache_mm
+            load_distance = self.get_bowden_cache_mm(self.Selected_Filament)
 
         # filament caching
         is_cached = False
@@ -764,12 +1719,15 @@ class ROME:
             if self.tool_count > 2:
                 if self.is_filament_cached(self.Selected_Filament):
                     is_cached = False
+                    self.count_statistic('cache_hits')
                     self.respond("Filament " + str(self.Selected_Filament) + " is cached!")
-                    load_distance = self.toolhead_sensor_to_bowden_cache_mm
+                    load_distance = self.get_bowden_cache_mm(self.Selected_Filament)
                 else:
+                    self.count_statistic('cache_misses')
                     demanded_filament = self.Selected_Filament
                     blocked_filament = self.is_cache_blocked(demanded_filament)
                     if blocked_filament >= 0:
+                        self.count_statistic('cache_evictions')
                         self.respond("Filament " + str(demanded_filament) + " is blocked by filament " + str(blocked_filament))
                         if not self.unload_filament_from_caching_position_to_reverse_bowden(blocked_filament):
                             self.pause_rome()
@@ -781,33 +1739,37 @@ class ROME:
             find_distance = 100
             if is_cached:
                 load_distance = load_distance - find_distance
-                self.gcode.run_script_from_command('G92 E0')
-                self.gcode.run_script_from_command('G0 E' + str(find_distance) + ' F' + str(self.filament_homing_speed_mms * 60))
-                self.gcode.run_script_from_command('M400')
+                if not self.filament_move(find_distance, self.filament_homing_speed_mms):
+                    self.respond("Filament " + str(self.Selected_Filament) + " jammed!")
+                    return False
                 if not self.y_filament_sensor_triggered():
-                    self.gcode.run_script_from_command('G92 E0')
-                    self.gcode.run_script_from_command('G0 E-' + str(find_distance) + ' F' + str(self.filament_homing_speed_mms * 60))
-                    self.gcode.run_script_from_command('M400')
+                    self.run_gcode('G92 E0')
+                    self.run_gcode('G0 E-' + str(find_distance) + ' F' + str(self.filament_homing_speed_mms * 60))
+                    self.run_gcode('M400')
                     self.respond("Could not find filament " + str(self.Selected_Filament) + "!")
                     return False
         self.respond("Filament " + str(self.Selected_Filament) + " found!")
         
         # initial move
-        self.gcode.run_script_from_command('G92 E0')
-        self.gcode.run_script_from_command('G0 E' + str(load_distance) + ' F' + str(self.filament_homing_speed_mms * 60))
-        self.gcode.run_script_from_command('M400')
+        if not prefed:
+            if not self.filament_move(load_distance, self.filament_homing_speed_mms):
+                self.respond("Filament " + str(self.Selected_Filament) + " jammed!")
+                return False
 
         # try to find the sensor
         self.respond("try to find the sensor...")
         step_distance = 20
         max_step_count = 50
+        self.Sensor_Distance = 0.
         if not self.toolhead_filament_sensor_triggered():
-            for i in range(max_step_count):
-                self.gcode.run_script_from_command('G92 E0')
-                self.gcode.run_script_from_command('G0 E' + str(step_distance) + ' F' + str(self.filament_homing_speed_mms * 60))
-                self.gcode.run_script_from_command('M400')
+            for i in range(max_step_count * self.recovery_range_factor):
+                if not self.filament_move(step_distance, self.filament_homing_speed_mms):
+                    self.respond("Filament " + str(self.Selected_Filament) + " jammed!")
+                    return False
+                self.Sensor_Distance = self.Sensor_Distance + step_distance
                 if self.toolhead_filament_sensor_triggered():
                     break
+            self.observe_search_metric('toolhead_search', i + 1)
 
         # check if sensor was found
         self.respond("check if sensor was found...")
@@ -821,6 +1783,9 @@ class ROME:
                 self.respond("Could not position the filament in the filament sensor!")
                 return False
 
+            # distance beyond the configured bowden length until the sensor triggered
+            self.record_lane_wear(self.Selected_Filament, 'toolhead', self.Sensor_Distance)
+
         # success
         return True
 
@@ -828,39 +1793,63 @@ class ROME:
         self.respond("load_filament_from_toolhead_sensor_to_parking_position")
 
         # move filament to parking position
-        self.gcode.run_script_from_command('G92 E0')
-        self.gcode.run_script_from_command('G0 E' + str(self.toolhead_sensor_to_extruder_gear_mm + self.extruder_gear_to_parking_position_mm) + ' F' + str(self.filament_parking_speed_mms * 60))
-        self.gcode.run_script_from_command('M400')
+        self.run_gcode('G92 E0')
+        self.run_gcode('G0 E' + str(self.toolhead_sensor_to_extruder_gear_mm + self.extruder_gear_to_parking_position_mm) + ' F' + str(self.filament_parking_speed_mms * 60))
+        self.run_gcode('M400')
 
         # extruder push and pull test
         if self.extruder_push_and_pull_test:
             push_and_pull_offset = 10
-            self.gcode.run_script_from_command('G92 E0')
-            self.gcode.run_script_from_command('G0 E-' + str(self.toolhead_sensor_to_extruder_gear_mm + self.extruder_gear_to_parking_position_mm - push_and_pull_offset) + ' F' + str(self.filament_parking_speed_mms * 60))
-            self.gcode.run_script_from_command('M400')
+            self.run_gcode('G92 E0')
+            self.run_gcode('G0 E-' + str(self.toolhead_sensor_to_extruder_gear_mm + self.extruder_gear_to_parking_position_mm - push_and_pull_offset) + ' F' + str(self.filament_parking_speed_mms * 60))
+            self.run_gcode('M400')
             if not self.toolhead_filament_sensor_triggered():
                 self.respond("could not load filament into extruder!")
                 return False
-            self.gcode.run_script_from_command('G92 E0')
-            self.gcode.run_script_from_command('G0 E' + str(self.toolhead_sensor_to_extruder_gear_mm + self.extruder_gear_to_parking_position_mm - push_and_pull_offset) + ' F' + str(self.filament_parking_speed_mms * 60))
-            self.gcode.run_script_from_command('M400')
+            self.run_gcode('G92 E0')
+            self.run_gcode('G0 E' + str(self.toolhead_sensor_to_extruder_gear_mm + self.extruder_gear_to_parking_position_mm - push_and_pull_offset) + ' F' + str(self.filament_parking_speed_mms * 60))
+            self.run_gcode('M400')
 
         # success
         return True
 
-    def load_filament_from_parking_position_to_nozzle(self):
+    def load_filament_from_parking_position_to_nozzle(self, purge_length=0.):
         self.respond("load_filament_from_parking_position_to_nozzle")
+        ooze_ex = self.is_ooze_ex_active()
+        fast_distance, fast_speed, melt_distance, melt_speed = self.get_nozzle_loading_profile(purge_length)
+
+        # raise the heater target while the cold filament approaches the melt zone, only a target bump without
+        # waiting for the heater, it is not a heater power feed forward
+        target_temperature = self.get_target_temperature()
+        if self.nozzle_loading_temperature_boost > 0 and target_temperature > 0:
+            self.extruder_set_temperature(min(target_temperature + self.nozzle_loading_temperature_boost, self.heater.max_temp), False)
 
         # load filament into nozzle
-        self.gcode.run_script_from_command('G92 E0')
-        if self.cmd_origin != "rome" or self.exchange_old_position == None or self.use_ooze_ex == 0:
-            self.gcode.run_script_from_command('G0 E' + str(self.parking_position_to_nozzle_mm) + ' F' + str(self.nozzle_loading_speed_mms * 60))
+        self.run_gcode('G92 E0')
+        if fast_distance > 0:
+            self.run_gcode('G0 E' + str(fast_distance) + ' F' + str(fast_speed * 60))
+        if not ooze_ex:
+            if melt_distance > 0:
+                self.run_gcode('G0 E' + str(melt_distance) + ' F' + str(melt_speed * 60))
         else:
-            self.gcode.run_script_from_command('G0 E' + str(self.parking_position_to_nozzle_mm / 2) + ' X' + str(self.ooze_move_x) + ' F' + str(self.nozzle_loading_speed_mms * 60))
-            self.gcode.run_script_from_command('G0 E' + str(self.parking_position_to_nozzle_mm / 2) + ' X' + str(self.exchange_old_position[0]) + ' F' + str(self.nozzle_loading_speed_mms * 60))
-        self.gcode.run_script_from_command('G4 P1000')
-        self.gcode.run_script_from_command('G92 E0')
-        self.gcode.run_script_from_command('M400')
+            # the purge is spread over additional ooze ex passes
+            passes = max(1, int(round(melt_distance / self.parking_position_to_nozzle_mm)))
+            pass_distance = melt_distance / passes / 2
+            feedrate = self.nozzle_loading_speed_mms * 60
+            if self.nozzle_max_volumetric_flow > 0:
+                # the feedrate applies to the x move, scale it so that the extruder moves at the melt speed
+                x_distance = abs(self.ooze_move_x - self.exchange_old_position[0])
+                feedrate = melt_speed * 60
+                if x_distance > 0 and pass_distance > 0:
+                    feedrate = melt_speed * x_distance / pass_distance * 60
+            for i in range(passes):
+                self.run_gcode('G0 E' + str(pass_distance) + ' X' + str(self.ooze_move_x) + ' F' + str(feedrate))
+                self.run_gcode('G0 E' + str(pass_distance) + ' X' + str(self.exchange_old_position[0]) + ' F' + str(feedrate))
+        self.run_gcode('G4 P1000')
+        self.run_gcode('G92 E0')
+        self.run_gcode('M400')
+        if self.nozzle_loading_temperature_boost > 0 and target_temperature > 0:
+            self.extruder_set_temperature(target_temperature, False)
 
         # release mmu splitter idler
         if self.rome_setup == 1:
@@ -869,6 +1858,16 @@ class ROME:
         # success
         return True
 
+    def get_nozzle_loading_profile(self, purge_length=0.):
+        load_distance = self.parking_position_to_nozzle_mm + purge_length
+        if self.nozzle_max_volumetric_flow <= 0:
+            return 0., self.nozzle_loading_speed_mms, load_distance, self.nozzle_loading_speed_mms
+
+        # cold filament moves fast until it reaches the melt zone, from there the melt rate limits the speed
+        fast_distance = max(0., self.parking_position_to_nozzle_mm - self.nozzle_melt_zone_mm)
+        melt_speed = self.nozzle_max_volumetric_flow / self.extruder.filament_area
+        return fast_distance, self.filament_parking_speed_mms, load_distance - fast_distance, melt_speed
+
     # -----------------------------------------------------------------------------------------------------------------------------
     # Unload Filament
     # -----------------------------------------------------------------------------------------------------------------------------
@@ -878,10 +1877,10 @@ class ROME:
 
         # unload filament to parking position
         if self.cmd_origin != "rome" or self.exchange_old_position == None or self.use_ooze_ex == 0:
-            self.gcode.run_script_from_command('_UNLOAD_FROM_NOZZLE_TO_PARKING_POSITION PAUSE=3000')
+            self.run_gcode('_UNLOAD_FROM_NOZZLE_TO_PARKING_POSITION PAUSE=3000')
         else:
-            self.gcode.run_script_from_command('_UNLOAD_FROM_NOZZLE_TO_PARKING_POSITION PAUSE=1')
-            self.gcode.run_script_from_command('G0 X' + str(self.ooze_move_x) + ' F600')
+            self.run_gcode('_UNLOAD_FROM_NOZZLE_TO_PARKING_POSITION PAUSE=1')
+            self.run_gcode('G0 X' + str(self.ooze_move_x) + ' F600')
 
         # success
         return True
@@ -894,15 +1893,15 @@ class ROME:
             self.select_idler(self.Selected_Filament)
 
         # unload filament to toolhead sensor
-        self.gcode.run_script_from_command('G92 E0')
-        self.gcode.run_script_from_command('M400')
+        self.run_gcode('G92 E0')
+        self.run_gcode('M400')
         if self.cmd_origin != "rome" or self.exchange_old_position == None or self.use_ooze_ex == 0:
-            self.gcode.run_script_from_command('G0 E-' + str(self.extruder_gear_to_parking_position_mm + self.toolhead_sensor_to_extruder_gear_mm) + ' F' + str(self.filament_parking_speed_mms * 60))
+            self.run_gcode('G0 E-' + str(self.extruder_gear_to_parking_position_mm + self.toolhead_sensor_to_extruder_gear_mm) + ' F' + str(self.filament_parking_speed_mms * 60))
         else:
-            self.gcode.run_script_from_command('G0 E-' + str(self.extruder_gear_to_parking_position_mm + self.toolhead_sensor_to_extruder_gear_mm) + ' X' + str(self.exchange_old_position[0]) + ' F' + str(self.filament_parking_speed_mms * 60))
-            # self.gcode.run_script_from_command('G0 E-' + str(self.extruder_gear_to_parking_position_mm) + ' X' + str(self.exchange_old_position[0]) + ' F' + str(self.filament_parking_speed_mms * 60))
-            # self.gcode.run_script_from_command('G0 E-' + str(self.toolhead_sensor_to_extruder_gear_mm) + ' F' + str(self.filament_parking_speed_mms * 60))
-        self.gcode.run_script_from_command('M400')
+            self.run_gcode('G0 E-' + str(self.extruder_gear_to_parking_position_mm + self.toolhead_sensor_to_extruder_gear_mm) + ' X' + str(self.exchange_old_position[0]) + ' F' + str(self.filament_parking_speed_mms * 60))
+            # self.run_gcode('G0 E-' + str(self.extruder_gear_to_parking_position_mm) + ' X' + str(self.exchange_old_position[0]) + ' F' + str(self.filament_parking_speed_mms * 60))
+            # self.run_gcode('G0 E-' + str(self.toolhead_sensor_to_extruder_gear_mm) + ' F' + str(self.filament_parking_speed_mms * 60))
+        self.run_gcode('M400')
 
         # success
         return True
@@ -912,9 +1911,9 @@ class ROME:
         self.respond("new_filament " + str(new_filament))
 
         # set unload distance
-        unload_distance = self.toolhead_sensor_to_bowden_parking_mm
+        unload_distance = self.get_bowden_parking_mm(self.Selected_Filament)
         if self.rome_setup == 0:
-            unload_distance = self.toolhead_sensor_to_bowden_cache_mm
+            unload_distance = self.get_bowden_cache_mm(self.Selected_Filament)
 
         # filament caching
         is_cached = False
@@ -922,13 +1921,12 @@ class ROME:
             if not self.is_in_same_filament_group(new_filament, self.Selected_Filament):
                 self.respond("filament is not in same filament group, caching filament " + str(self.Selected_Filament))
                 self.cache_filament(self.Selected_Filament)
-                unload_distance = self.toolhead_sensor_to_bowden_cache_mm
+                unload_distance = self.get_bowden_cache_mm(self.Selected_Filament)
                 is_cached = True
 
         # eject filament
-        self.gcode.run_script_from_command('G92 E0')
-        self.gcode.run_script_from_command('G0 E-' + str(unload_distance) + ' F' + str(self.filament_homing_speed_mms * 60))
-        self.gcode.run_script_from_command('M400')
+        if not self.filament_move(-unload_distance, self.filament_homing_speed_mms):
+            return False
 
         # check if filament is ejected from toolhead
         if self.toolhead_filament_sensor_triggered():
@@ -937,7 +1935,7 @@ class ROME:
         # park filament
         if self.rome_setup == 1:
             if not is_cached:
-                if not self.park_filament():
+                if not self.park_filament(True):
                     return False
 
         # uncache filament
@@ -954,9 +1952,8 @@ class ROME:
         self.select_tool(filament)
 
         # eject filament
-        self.gcode.run_script_from_command('G92 E0')
-        self.gcode.run_script_from_command('G0 E-' + str(self.toolhead_sensor_to_bowden_parking_mm - self.toolhead_sensor_to_bowden_cache_mm) + ' F' + str(self.filament_homing_speed_mms * 60))
-        self.gcode.run_script_from_command('M400')
+        if not self.filament_move(-(self.get_bowden_parking_mm(filament) - self.get_bowden_cache_mm(filament)), self.filament_homing_speed_mms):
+            return False
 
         # check if filament is ejected
         if self.toolhead_filament_sensor_triggered():
@@ -976,19 +1973,21 @@ class ROME:
     # -----------------------------------------------------------------------------------------------------------------------------
     # Parking Parking
     # -----------------------------------------------------------------------------------------------------------------------------
-    def park_filament(self):
+    def park_filament(self, lane_wear=False):
     
         # try to find the y sensor
         self.respond("try to find the sensor...")
         step_distance = 20
         max_step_count = 50
+        self.Sensor_Distance = 0.
         if self.y_filament_sensor_triggered():
-            for i in range(max_step_count):
-                self.gcode.run_script_from_command('G92 E0')
-                self.gcode.run_script_from_command('G0 E-' + str(step_distance) + ' F' + str(self.filament_homing_speed_mms * 60))
-                self.gcode.run_script_from_command('M400')
+            for i in range(max_step_count * self.recovery_range_factor):
+                if not self.filament_move(-step_distance, self.filament_homing_speed_mms):
+                    return False
+                self.Sensor_Distance = self.Sensor_Distance - step_distance
                 if not self.y_filament_sensor_triggered():
                     break
+            self.observe_search_metric('y_search', i + 1)
 
         # check if y sensor was found
         self.respond("check if y sensor was found...")
@@ -1001,10 +2000,14 @@ class ROME:
             self.respond("Could not park the filament in the parking sensor!")
             return False
 
+        # distance beyond the configured bowden length until the y sensor released
+        if lane_wear:
+            self.record_lane_wear(self.Selected_Filament, 'parking', -self.Sensor_Distance)
+
         # parking filament in final parking position
-        self.gcode.run_script_from_command('G92 E0')
-        self.gcode.run_script_from_command('G0 E-48 F' + str(self.filament_homing_speed_mms * 60))
-        self.gcode.run_script_from_command('M400')
+        self.run_gcode('G92 E0')
+        self.run_gcode('G0 E-' + str(self.y_sensor_to_parking_position_mm) + ' F' + str(self.filament_homing_speed_mms * 60))
+        self.run_gcode('M400')
 
         # success
         return True
@@ -1017,6 +2020,7 @@ class ROME:
 
         # exact parking
         if not self.exact_parking():
+            self.count_statistic('retries')
             if not self.fast_parking():
                 return False
             if not self.exact_parking():
@@ -1032,12 +2036,14 @@ class ROME:
         max_step_count = 20
 
         # find parking sensor
-        for i in range(max_step_count):
-            self.gcode.run_script_from_command('G92 E0')
-            self.gcode.run_script_from_command('G0 E' + str(accuracy_in_mm) + ' F' + str(self.filament_homing_speed_mms * 60))
-            self.gcode.run_script_from_command('M400')
+        for i in range(max_step_count * self.recovery_range_factor):
+            self.run_gcode('G92 E0')
+            self.run_gcode('G0 E' + str(accuracy_in_mm) + ' F' + str(self.filament_homing_speed_mms * 60))
+            self.run_gcode('M400')
+            self.Sensor_Distance = self.Sensor_Distance + accuracy_in_mm
             if self.y_filament_sensor_triggered():
                 break
+        self.observe_search_metric('fast_parking', i + 1)
 
         # check parking success
         if not self.y_filament_sensor_triggered():
@@ -1053,12 +2059,14 @@ class ROME:
         max_step_count = 20
 
         # find parking sensor
-        for n in range(max_step_count):
-            self.gcode.run_script_from_command('G92 E0')
-            self.gcode.run_script_from_command('G0 E-' + str(accuracy_in_mm) + ' F' + str(self.filament_homing_speed_mms * 60))
-            self.gcode.run_script_from_command('M400')
+        for n in range(max_step_count * self.recovery_range_factor):
+            self.run_gcode('G92 E0')
+            self.run_gcode('G0 E-' + str(accuracy_in_mm) + ' F' + str(self.filament_homing_speed_mms * 60))
+            self.run_gcode('M400')
+            self.Sensor_Distance = self.Sensor_Distance - accuracy_in_mm
             if not self.y_filament_sensor_triggered():
                 break
+        self.observe_search_metric('exact_parking', n + 1)
 
         # check parking success
         if self.y_filament_sensor_triggered():
@@ -1074,11 +2082,13 @@ class ROME:
 
         # fast positioning
         if not self.fast_positioning():
+            self.count_statistic('retries')
             if not self.exact_positioning():
                 return False
 
         # exact positioning
         if not self.exact_positioning():
+            self.count_statistic('retries')
             if not self.fast_positioning():
                 return False
             if not self.exact_positioning():
@@ -1094,12 +2104,14 @@ class ROME:
         max_step_count = 20
 
         # find toolhead sensor
-        for i in range(max_step_count):
-            self.gcode.run_script_from_command('G92 E0')
-            self.gcode.run_script_from_command('G0 E-' + str(accuracy_in_mm) + ' F' + str(self.filament_homing_speed_mms * 60))
-            self.gcode.run_script_from_command('M400')
+        for i in range(max_step_count * self.recovery_range_factor):
+            self.run_gcode('G92 E0')
+            self.run_gcode('G0 E-' + str(accuracy_in_mm) + ' F' + str(self.filament_homing_speed_mms * 60))
+            self.run_gcode('M400')
+            self.Sensor_Distance = self.Sensor_Distance - accuracy_in_mm
             if not self.toolhead_filament_sensor_triggered():
                 break
+        self.observe_search_metric('fast_positioning', i + 1)
 
         # check positioning success
         if self.toolhead_filament_sensor_triggered():
@@ -1115,12 +2127,14 @@ class ROME:
         max_step_count = 20
 
         # find toolhead sensor
-        for n in range(max_step_count):
-            self.gcode.run_script_from_command('G92 E0')
-            self.gcode.run_script_from_command('G0 E' + str(accuracy_in_mm) + ' F' + str(self.filament_homing_speed_mms * 60))
-            self.gcode.run_script_from_command('M400')
+        for n in range(max_step_count * self.recovery_range_factor):
+            self.run_gcode('G92 E0')
+            self.run_gcode('G0 E' + str(accuracy_in_mm) + ' F' + str(self.filament_homing_speed_mms * 60))
+            self.run_gcode('M400')
+            self.Sensor_Distance = self.Sensor_Distance + accuracy_in_mm
             if self.toolhead_filament_sensor_triggered():
                 break
+        self.observe_search_metric('exact_positioning', n + 1)
 
         # check positioning success
         if not self.toolhead_filament_sensor_triggered():
@@ -1130,19 +2144,137 @@ class ROME:
         return True
 
     # -----------------------------------------------------------------------------------------------------------------------------
-    # Filament Caching
+    # Filament Move
     # -----------------------------------------------------------------------------------------------------------------------------
-    Filament_Groups = [[1,2],[4,5]]
+    stallguard_poll_interval = 0.05
+    stallguard_settle_time = 0.1
+    stallguard_lead_time = 0.1
+
+    def filament_move(self, distance, speed):
+        self.Metric_Filament_Distance = self.Metric_Filament_Distance + abs(distance)
+
+        # unmonitored move
+        if not self.stallguard_monitoring or abs(distance) < self.stallguard_check_distance_mm:
+            self.run_gcode('G92 E0')
+            self.run_gcode('G0 E' + str(distance) + ' F' + str(speed * 60))
+            self.run_gcode('M400')
+            return True
+
+        # monitored move, split into chunks so that a stall aborts the move early
+        direction = 1 if distance > 0 else -1
+        remaining = abs(distance)
+        retries = 0
+        while remaining > 0:
+            chunk = min(remaining, self.stallguard_check_distance_mm)
+            self.run_gcode('G92 E0')
+            self.run_gcode('G0 E' + str(direction * chunk) + ' F' + str(speed * 60))
+            stalled_stepper = self.wait_for_filament_move(chunk / speed)
+            if stalled_stepper is None:
+                remaining = remaining - chunk
+                continue
+
+            # stall detected
+            self.run_gcode('M400')
+            self.count_statistic('stalls')
+            self.respond("Stall detected on " + stalled_stepper + "!")
+            if retries >= self.stallguard_retries:
+                return False
+            retries = retries + 1
+
+            # back off and retry
+            self.count_statistic('retries')
+            self.respond("Retrying move, attempt " + str(retries) + " of " + str(self.stallguard_retries))
+            self.run_gcode('G92 E0')
+            self.run_gcode('G0 E' + str(-direction * self.stallguard_backoff_mm) + ' F' + str(speed * 60))
+            self.run_gcode('M400')
+            remaining = remaining + self.stallguard_backoff_mm
+        self.run_gcode('M400')
+
+        # success
+        return True
+
+    def wait_for_filament_move(self, move_time):
+
+        # poll the drivers while the queued move is running
+        drivers = self.get_filament_drivers()
+        end_time = self.toolhead.get_last_move_time()
+        start_time = end_time - move_time + self.stallguard_settle_time
+        eventtime = self.reactor.monotonic()
+        print_time = self.mcu.estimated_print_time(eventtime)
+        while print_time < end_time - self.stallguard_lead_time:
+            if print_time >= start_time:
+                for stepper_name, driver in drivers:
+                    if self.stepper_driver_stalled(driver):
+                        return stepper_name
+            eventtime = self.reactor.pause(eventtime + self.stallguard_poll_interval)
+            print_time = self.mcu.estimated_print_time(eventtime)
+        return None
+
+    def get_filament_drivers(self):
+        stepper_names = []
+        if self.rome_setup == 0:
+            for i in self.Synced_Tools:
+                stepper_names.append(self.get_lane_extruder(i))
+        elif self.rome_setup == 1 and self.Synced_Pulley:
+            stepper_names.append(self.Synced_Pulley)
+        drivers = []
+        for stepper_name in stepper_names:
+            driver = self.stepper_driver(stepper_name, 'extruder_stepper')
+            if driver is not None:
+                drivers.append((stepper_name, driver))
+        return drivers
 
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Filament Caching
+    # -----------------------------------------------------------------------------------------------------------------------------
     def cache_filament(self, filament):
         self.Filament_Cache[filament - 1] = True
 
     def uncache_all(self):
         self.respond("uncache_all " + str(self.Filament_Cache))
-        for i in range(0, self.tool_count - 1):
-            if self.Filament_Cache[i] == True:
-                self.select_tool(i + 1)
-                self.unload_filament_from_caching_position_to_reverse_bowden(i + 1)
+        cached_filaments = []
+        for i in range(1, self.tool_count + 1):
+            if self.is_filament_cached(i):
+                cached_filaments.append(i)
+        if len(cached_filaments) == 0:
+            return True
+
+        # extruder feeders can retract all cached filaments at once
+        if self.rome_setup == 0:
+            return self.uncache_filaments_extruder_feeder(cached_filaments)
+
+        # the mmu splitter moves one filament at a time
+        for filament in cached_filaments:
+            if not self.unload_filament_from_caching_position_to_reverse_bowden(filament):
+                self.respond("could not uncache filament " + str(filament) + "!")
+                return False
+
+        # success
+        return True
+
+    def uncache_filaments_extruder_feeder(self, filaments):
+
+        # retract all filaments together
+        distances = {}
+        for filament in filaments:
+            distances[filament] = -(self.get_bowden_parking_mm(filament) - self.get_bowden_cache_mm(filament))
+        if not self.filament_move_extruder_feeders(distances, self.filament_homing_speed_mms):
+            self.respond("could not uncache filaments " + str(filaments) + "!")
+            return False
+
+        # verify all filaments in a single pass
+        if self.toolhead_filament_sensor_triggered():
+            self.respond("could not uncache filaments " + str(filaments) + "!")
+            return False
+        for filament in filaments:
+            if self.y_filament_sensor_triggered(filament):
+                self.respond("could not uncache filament " + str(filament) + "!")
+                return False
+        for filament in filaments:
+            self.uncache_filament(filament)
+
+        # success
+        return True
 
     def uncache_filament(self, filament):
         self.Filament_Cache[filament - 1] = False
@@ -1165,11 +2297,9 @@ class ROME:
         return self.get_filament_group(new_filament) == self.get_filament_group(old_filament)
 
     def get_filament_group(self, filament):
-        for g in range(0, len(self.Filament_Groups)):
-            for f in range(0, len(self.Filament_Groups[g])):
-                if self.Filament_Groups[g][f] == filament:
-                    return g
-        return -1
+        if filament < 1 or filament > self.tool_count:
+            return -1
+        return self.Lane_Groups[filament - 1]
 
     # -----------------------------------------------------------------------------------------------------------------------------
     # Filament Sensor
@@ -1180,20 +2310,304 @@ class ROME:
     def runout_gcode(self):
         self.respond("runout_gcode")
 
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Filament Usage
+    # -----------------------------------------------------------------------------------------------------------------------------
+    Usage_Tool = -1
+    Usage_Start_Position = 0.
+
+    def start_usage_tracking(self, tool):
+        self.Usage_Tool = tool
+        self.Usage_Start_Position = self.toolhead.get_position()[3]
+
+    def stop_usage_tracking(self):
+        if self.Usage_Tool < 1:
+            return
+        used = self.toolhead.get_position()[3] - self.Usage_Start_Position
+        self.Filament_Usage[self.Usage_Tool - 1] = self.Filament_Usage[self.Usage_Tool - 1] + used
+        if self.Spool_Remaining[self.Usage_Tool - 1] is not None:
+            self.Spool_Remaining[self.Usage_Tool - 1] = max(0., self.Spool_Remaining[self.Usage_Tool - 1] - used)
+        self.Usage_Tool = -1
+
+    def get_filament_usage(self, tool):
+        used = self.Filament_Usage[tool - 1]
+        if self.Usage_Tool == tool:
+            used = used + self.toolhead.get_position()[3] - self.Usage_Start_Position
+        return used
+
+    def get_spool_remaining(self, tool):
+        remaining = self.Spool_Remaining[tool - 1]
+        if remaining is not None and self.Usage_Tool == tool:
+            remaining = max(0., remaining - (self.toolhead.get_position()[3] - self.Usage_Start_Position))
+        return remaining
+
+    def is_runout_predicted(self, tool):
+        remaining = self.get_spool_remaining(tool)
+        return remaining is not None and remaining < self.runout_reserve_mm
+
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Infinite Spool
+    # -----------------------------------------------------------------------------------------------------------------------------
+    def get_mapped_tool(self, tool):
+        return self.Tool_Mapping.get(tool, tool)
+
+    def map_tool(self, tool, backup_tool):
+        for i in range(1, self.tool_count + 1):
+            if self.get_mapped_tool(i) == tool:
+                self.Tool_Mapping[i] = backup_tool
+
+    def get_backup_tool(self, tool):
+        backup_tool = self.Infinite_Spool_Backup.get(tool, -1)
+        if backup_tool < 1 or backup_tool > self.tool_count or self.is_runout_predicted(backup_tool):
+            return -1
+        return backup_tool
+
+    def get_planned_tool(self, tool):
+        mapped_tool = self.get_mapped_tool(tool)
+
+        # switch to the backup spool before the spool runs out
+        if self.infinite_spool == True and self.is_runout_predicted(mapped_tool):
+            backup_tool = self.get_backup_tool(mapped_tool)
+            if backup_tool >= 0:
+                self.respond("Filament " + str(mapped_tool) + " is about to run out, switching to filament " + str(backup_tool))
+                self.map_tool(mapped_tool, backup_tool)
+                mapped_tool = backup_tool
+
+        return mapped_tool
+
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Persistent State
+    # -----------------------------------------------------------------------------------------------------------------------------
+    Stored_State = None
+    Saved_State = None
+
+    def get_state(self, busy):
+        state = {
+            'busy': busy,
+            'homed': self.Homed,
+            'selected_filament': self.Selected_Filament,
+            'filament_cache': list(self.Filament_Cache),
+            'spool_remaining': list(self.Spool_Remaining),
+            'cost_factors': self.Cost_Factors,
+            'lane_wear': self.Lane_Wear,
+            'idler_positions': list(self.Unit_Idler_Positions),
+            'staged_tool': self.Staged_Tool,
+            'sensors': self.get_sensor_states()
+        }
+        return state
+
+    def get_sensor_states(self):
+        sensors = {}
+        for filament_sensor in self.printer.lookup_objects('filament_switch_sensor'):
+            sensors[filament_sensor[1].runout_helper.name] = bool(filament_sensor[1].runout_helper.filament_present)
+        return sensors
+
+    def save_state(self, busy=False):
+        if not self.persist_state:
+            return
+
+        # skip unchanged state
+        data = json.dumps(self.get_state(busy), sort_keys=True)
+        if data == self.Saved_State:
+            return
+
+        # atomic write
+        content = json.dumps({'checksum': zlib.crc32(data.encode()), 'state': data})
+        temp_file = self.state_file + '.tmp'
+        try:
+            with open(temp_file, 'w') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, self.state_file)
+            self.Saved_State = data
+        except (IOError, OSError):
+            logging.exception("rome: unable to save state to " + self.state_file)
+
+    def load_state(self):
+        self.Stored_State = None
+        if not self.persist_state or not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, 'r') as f:
+                content = json.loads(f.read())
+            data = content['state']
+            if zlib.crc32(data.encode()) != content['checksum']:
+                logging.info("rome: state file checksum mismatch, ignoring " + self.state_file)
+                return
+            state = json.loads(data)
+            if len(state['filament_cache']) != self.tool_count:
+                return
+            if len(state.get('spool_remaining', [])) == self.tool_count:
+                self.Spool_Remaining = state['spool_remaining']
+            self.Cost_Factors = state.get('cost_factors', {})
+            if len(state.get('lane_wear', [])) == self.tool_count:
+                self.Lane_Wear = state['lane_wear']
+            self.Stored_State = state
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            logging.exception("rome: unable to load state from " + self.state_file)
+
+    def restore_state(self, eventtime):
+        state = self.Stored_State
+        self.Stored_State = None
+
+        # validate stored state against the current sensor readings
+        if state['busy'] or not state['homed']:
+            return
+        if state['sensors'] != self.get_sensor_states():
+            self.respond("ROME state does not match the filament sensors, homing required")
+            return
+        if self.rome_setup == 1 and len(state.get('idler_positions', [])) != len(self.Unit_Idlers):
+            return
+
+        # restore
+        self.Homed = True
+        self.Selected_Filament = state['selected_filament']
+        self.Filament_Cache = state['filament_cache']
+        self.Staged_Tool = state.get('staged_tool', None)
+        if self.rome_setup == 1:
+            # an idler without a position is homed before its next move
+            for unit in range(len(self.Unit_Idlers)):
+                if state['idler_positions'][unit] is not None:
+                    self.Unit_Idlers[unit].do_set_position(state['idler_positions'][unit])
+                self.Unit_Idler_Positions[unit] = state['idler_positions'][unit]
+        self.Saved_State = json.dumps(self.get_state(False), sort_keys=True)
+        self.respond("ROME state restored, tool " + str(self.Selected_Filament) + " selected")
+
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Recovery
+    # -----------------------------------------------------------------------------------------------------------------------------
+    recovery_strategy_names = ['retry', 'backoff', 'slow', 'home_idler', 'wide_positioning']
+
+    # only a failed load or unload phase leaves the filament positions known enough to retry
+    recovery_phases = ['unload_nozzle', 'unload_parking', 'unload_bowden', 'unload_check', 'load_bowden', 'load_parking', 'load_nozzle']
+    recovery_range_factor = 1
+    Failed_Phase = None
+    Recovery_Previous_Filament = -1
+
+    def recover_tool_change(self, tool, temp, cache):
+        if self.recovery_attempts == 0 or not self.Homed:
+            return False
+        failed_phase = self.Failed_Phase
+        for attempt in range(self.recovery_attempts):
+            if failed_phase not in self.recovery_phases:
+                self.respond("No recovery after " + str(failed_phase) + " failed, the toolhead state is unknown!")
+                return False
+            strategy = self.Recovery_Strategies[attempt % len(self.Recovery_Strategies)]
+            self.respond("Recovery attempt " + str(attempt + 1) + " of " + str(self.recovery_attempts) + " after " + str(failed_phase) + " failed: " + strategy)
+            self.count_statistic('recovery_attempts')
+
+            # retry the tool change with the strategy applied
+            start_time = self.reactor.monotonic()
+            self.Failed_Phase = None
+            saved_settings = self.prepare_recovery(strategy, failed_phase)
+            try:
+                success = self.retry_tool_change(tool, temp, cache)
+            finally:
+                self.finish_recovery(saved_settings)
+            self.Recovery_Log.append({
+                'time': time.time(),
+                'tool': tool,
+                'failed_phase': failed_phase,
+                'attempt': attempt + 1,
+                'strategy': strategy,
+                'success': success,
+                'duration': self.reactor.monotonic() - start_time
+            })
+            logging.info("rome: recovery " + str(self.Recovery_Log[-1]))
+
+            if success:
+                self.count_statistic('recoveries')
+                self.respond("Recovered with " + strategy + "!")
+                return True
+            if self.Failed_Phase is not None:
+                failed_phase = self.Failed_Phase
+
+        self.respond("Recovery failed after " + str(self.recovery_attempts) + " attempts!")
+        return False
+
+    def prepare_recovery(self, strategy, failed_phase):
+        saved_settings = (self.filament_homing_speed_mms, self.filament_parking_speed_mms, self.nozzle_loading_speed_mms, self.nozzle_max_volumetric_flow)
+        if strategy == 'backoff':
+            # the filament is only pulled back when the failed phase tells where it is
+            if self.Selected_Filament >= 1 and failed_phase in self.recovery_phases:
+                self.select_tool(self.Selected_Filament)
+                self.filament_move(-self.recovery_backoff_mm, self.filament_homing_speed_mms)
+        elif strategy == 'slow':
+            self.filament_homing_speed_mms = self.filament_homing_speed_mms * self.recovery_speed_factor
+            self.filament_parking_speed_mms = self.filament_parking_speed_mms * self.recovery_speed_factor
+            self.nozzle_loading_speed_mms = self.nozzle_loading_speed_mms * self.recovery_speed_factor
+            self.nozzle_max_volumetric_flow = self.nozzle_max_volumetric_flow * self.recovery_speed_factor
+        elif strategy == 'home_idler':
+            if self.Selected_Filament >= 1:
+                self.home_idler(self.get_lane_unit(self.Selected_Filament))
+        elif strategy == 'wide_positioning':
+            self.recovery_range_factor = 2
+        return saved_settings
+
+    def finish_recovery(self, saved_settings):
+        self.filament_homing_speed_mms, self.filament_parking_speed_mms, self.nozzle_loading_speed_mms, self.nozzle_max_volumetric_flow = saved_settings
+        self.recovery_range_factor = 1
+
+    def retry_tool_change(self, tool, temp, cache):
+        previous_filament = self.Recovery_Previous_Filament
+
+        # the previous filament is still in the toolhead, it has already left the nozzle
+        if self.toolhead_filament_sensor_triggered() and self.Selected_Filament != tool:
+            self.select_tool(self.Selected_Filament)
+            if not self.timed_phase('unload_parking', self.unload_filament_from_parking_position_to_toolhead_sensor):
+                return False
+            if not self.timed_phase('unload_bowden', self.unload_filament_from_toolhead_sensor, tool, cache):
+                return False
+
+        # the previous filament is still in front of its y sensor
+        if previous_filament >= 1 and previous_filament != tool and not self.is_filament_cached(previous_filament):
+            if self.y_filament_sensor_triggered(previous_filament):
+                self.select_tool(previous_filament)
+                if not self.clear_y_sensor():
+                    self.Failed_Phase = 'unload_check'
+                    return False
+
+        # a filament that has already been fed is searched from its current position
+        prefed = self.Selected_Filament == tool
+        self.select_tool(tool)
+        return self.load_selected_tool(tool, temp, prefed, self.get_change_purge_length(previous_filament))
+
+    def clear_y_sensor(self):
+        if self.rome_setup == 1:
+            return self.park_filament()
+        step_distance = 20
+        max_step_count = 10
+        for i in range(max_step_count * self.recovery_range_factor):
+            if not self.y_filament_sensor_triggered():
+                return True
+            if not self.filament_move(-step_distance, self.filament_homing_speed_mms):
+                return False
+        return not self.y_filament_sensor_triggered()
+
     # -----------------------------------------------------------------------------------------------------------------------------
     # Pause
     # -----------------------------------------------------------------------------------------------------------------------------
     Paused = False
 
     def pause_rome(self):
+        logging.info("pause rome")
         self.Paused = True
+        self.count_statistic('pauses')
+
+        # a failed change never reaches after_change, the print resumes with its own limits
+        self.restore_change_kinematic_profile()
+
+        # keep the sensor history that led to the pause
+        if self.sensor_telemetry and self.sensor_telemetry_dump_on_pause:
+            self.dump_sensor_telemetry(self.sensor_telemetry_file)
 
         # enable heater timeout
         #if self.heater_timeout > 0:
         #    self.enable_heater_timeout()
 
         # call pause macro 
-        self.gcode.run_script_from_command("_PAUSE_ROME IDLE_TIMEOUT=" + str(self.idle_timeout))
+        self.run_gcode("_PAUSE_ROME IDLE_TIMEOUT=" + str(self.idle_timeout))
 
     def resume_rome(self):
         self.Paused = False
@@ -1204,38 +2618,777 @@ class ROME:
 
         # go to last position
         if self.exchange_old_position != None:
-            self.gcode.run_script_from_command('G0 Z' + str(self.exchange_old_position[2] + 2) + ' F3600')
-            self.gcode.run_script_from_command('G0 X' + str(self.exchange_old_position[0]) + ' Y' + str(self.exchange_old_position[1]) + ' F3600')
-            self.gcode.run_script_from_command('M400')
+            self.run_gcode('G0 Z' + str(self.exchange_old_position[2] + 2) + ' F3600')
+            self.run_gcode('G0 X' + str(self.exchange_old_position[0]) + ' Y' + str(self.exchange_old_position[1]) + ' F3600')
+            self.run_gcode('M400')
 
         # disable filament sensor
         self.disable_toolhead_filament_sensor()
 
         # resume print
-        self.gcode.run_script_from_command("_RESUME_ROME")
+        self.run_gcode("_RESUME_ROME")
+
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Statistics
+    # -----------------------------------------------------------------------------------------------------------------------------
+    statistic_names = ['loads', 'changes', 'skipped_changes', 'failures', 'recovery_attempts', 'recoveries', 'retries', 'stalls', 'pauses', 'cache_hits', 'cache_misses', 'cache_evictions', 'runouts']
+    Phase_Recording = None
+
+    def count_statistic(self, statistic_name):
+        self.Statistics[statistic_name] = self.Statistics[statistic_name] + 1
+
+    def timed_phase(self, phase, function, *args):
+        start_time = self.reactor.monotonic()
+        self.Trace_Phases.append(phase)
+        kinematic_limits = self.apply_kinematic_profile(phase)
+        try:
+            result = function(*args)
+        finally:
+            self.Trace_Phases.pop()
+            if kinematic_limits is not None:
+                self.set_kinematic_limits(kinematic_limits)
+        duration = self.reactor.monotonic() - start_time
+        self.record_phase(phase, duration)
+        self.observe_phase_metric(phase, duration)
+        if result:
+            self.learn_phase_cost(phase, duration)
+        elif result is False and self.Failed_Phase is None:
+            self.Failed_Phase = phase
+        self.trace_event('phase', phase, start_time, duration)
+        return result
+
+    def record_phase(self, phase, duration):
+        if self.Phase_Recording is not None:
+            self.Phase_Recording.setdefault(phase, []).append(duration)
+
+    def get_distribution(self, values):
+        if len(values) == 0:
+            return {'count': 0}
+        values = sorted(values)
+        return {
+            'count': len(values),
+            'min': values[0],
+            'mean': sum(values) / len(values),
+            'median': values[len(values) // 2],
+            'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+            'max': values[-1]
+        }
+
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Metrics
+    # -----------------------------------------------------------------------------------------------------------------------------
+    metric_duration_buckets = [0.5, 1., 2., 5., 10., 20., 30., 60., 120., 300.]
+    metric_step_buckets = [1, 2, 3, 5, 10, 20, 50, 100]
+    metric_phase_names = ['change', 'unload_nozzle', 'unload_parking', 'unload_bowden', 'load_bowden', 'load_parking', 'heating', 'load_nozzle']
+    metric_search_names = ['toolhead_search', 'y_search', 'fast_parking', 'exact_parking', 'fast_positioning', 'exact_positioning']
+    Metric_Filament_Distance = 0.
+
+    def init_metrics(self):
+
+        # every histogram is allocated once, bucket counts followed by the sum of all observations
+        self.Phase_Histograms = {}
+        for phase in self.metric_phase_names:
+            self.Phase_Histograms[phase] = [0] * (len(self.metric_duration_buckets) + 1) + [0.]
+        self.Search_Histograms = {}
+        for search in self.metric_search_names:
+            self.Search_Histograms[search] = [0] * (len(self.metric_step_buckets) + 1) + [0]
+
+    def get_metrics_snapshot(self):
+        phase_histograms = dict([(phase, list(histogram)) for phase, histogram in self.Phase_Histograms.items()])
+        search_histograms = dict([(search, list(histogram)) for search, histogram in self.Search_Histograms.items()])
+        return phase_histograms, search_histograms, self.Metric_Filament_Distance
+
+    def restore_metrics_snapshot(self, snapshot):
+        phase_histograms, search_histograms, self.Metric_Filament_Distance = snapshot
+        for phase, histogram in phase_histograms.items():
+            self.Phase_Histograms[phase][:] = histogram
+        for search, histogram in search_histograms.items():
+            self.Search_Histograms[search][:] = histogram
+
+    def observe_phase_metric(self, phase, duration):
+        histogram = self.Phase_Histograms.get(phase)
+        if histogram is not None:
+            histogram[bisect_left(self.metric_duration_buckets, duration)] += 1
+            histogram[-1] += duration
+
+    def observe_search_metric(self, search, steps):
+        histogram = self.Search_Histograms[search]
+        histogram[bisect_left(self.metric_step_buckets, steps)] += 1
+        histogram[-1] += steps
+
+    def get_metrics_text(self):
+        lines = []
+        for statistic_name in self.statistic_names:
+            lines.append('# TYPE rome_' + statistic_name + '_total counter')
+            lines.append('rome_' + statistic_name + '_total ' + str(self.Statistics[statistic_name]))
+        lines.append('# TYPE rome_filament_moved_mm_total counter')
+        lines.append('rome_filament_moved_mm_total ' + str(round(self.Metric_Filament_Distance, 1)))
+        lines.append('# TYPE rome_selected_filament gauge')
+        lines.append('rome_selected_filament ' + str(self.Selected_Filament))
+        lines.append('# TYPE rome_phase_duration_seconds histogram')
+        for phase, histogram in self.Phase_Histograms.items():
+            self.append_histogram_lines(lines, 'rome_phase_duration_seconds', 'phase="' + phase + '"', self.metric_duration_buckets, histogram)
+        lines.append('# TYPE rome_sensor_search_steps histogram')
+        for search, histogram in self.Search_Histograms.items():
+            self.append_histogram_lines(lines, 'rome_sensor_search_steps', 'search="' + search + '"', self.metric_step_buckets, histogram)
+        return "\n".join(lines) + "\n"
+
+    def append_histogram_lines(self, lines, name, label, buckets, histogram):
+        count = 0
+        for i in range(0, len(buckets)):
+            count = count + histogram[i]
+            lines.append(name + '_bucket{' + label + ',le="' + str(buckets[i]) + '"} ' + str(count))
+        count = count + histogram[len(buckets)]
+        lines.append(name + '_bucket{' + label + ',le="+Inf"} ' + str(count))
+        lines.append(name + '_sum{' + label + '} ' + str(histogram[-1]))
+        lines.append(name + '_count{' + label + '} ' + str(count))
+
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Lane Wear
+    # -----------------------------------------------------------------------------------------------------------------------------
+    lane_wear_smoothing = 0.1
+    lane_wear_min_samples = 5
+    Sensor_Distance = 0.
+
+    def record_lane_wear(self, lane, sensor, distance):
+        if lane < 1 or lane > self.tool_count:
+            return
+        wear = self.Lane_Wear[lane - 1].get(sensor)
+        if wear is None:
+            wear = {'mean': distance, 'variance': 0., 'count': 0, 'warning': False}
+            self.Lane_Wear[lane - 1][sensor] = wear
+
+        # exponentially weighted mean and variance
+        difference = distance - wear['mean']
+        increment = self.lane_wear_smoothing * difference
+        wear['mean'] = wear['mean'] + increment
+        wear['variance'] = (1 - self.lane_wear_smoothing) * (wear['variance'] + difference * increment)
+        wear['count'] = wear['count'] + 1
+
+        # warn once when a lane starts drifting
+        warning = wear['count'] >= self.lane_wear_min_samples and (abs(wear['mean']) > self.lane_wear_warning_mm or sqrt(wear['variance']) > self.lane_wear_warning_stddev_mm)
+        if warning and not wear['warning']:
+            self.respond("Lane " + str(lane) + " " + sensor + " sensor drift " + str(round(wear['mean'], 1)) + "mm, deviation " + str(round(sqrt(wear['variance']), 1)) + "mm, check the feeder gears, the ptfe tube and the spool")
+        wear['warning'] = warning
+
+    def get_lane_wear(self):
+        lane_wear = []
+        for i in range(0, self.tool_count):
+            lane = {}
+            for sensor, wear in self.Lane_Wear[i].items():
+                lane[sensor] = {
+                    'mean': wear['mean'],
+                    'stddev': sqrt(wear['variance']),
+                    'count': wear['count'],
+                    'warning': wear['warning']
+                }
+            lane_wear.append(lane)
+        return lane_wear
+
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Cost Model
+    # -----------------------------------------------------------------------------------------------------------------------------
+    cost_model_smoothing = 0.2
+    cost_sensor_step_time = 0.3
+    cost_idler_select_time = 1.0
+
+    def estimate_unload(self, filament, new_filament, filament_cache, cache):
+        phases = {}
+        extruder_distance = self.toolhead_sensor_to_extruder_gear_mm + self.extruder_gear_to_parking_position_mm
+
+        # nozzle to toolhead sensor
+        if self.mode != "slicer":
+            phases['unload_nozzle'] = self.nozzle_unload_time
+        phases['unload_parking'] = extruder_distance / self.filament_parking_speed_mms
+        if self.rome_setup == 1:
+            phases['unload_parking'] += self.cost_idler_select_time
+
+        # toolhead sensor to cache or parking position
+        unload_distance = self.get_bowden_parking_mm(filament)
+        if self.rome_setup == 0:
+            unload_distance = self.get_bowden_cache_mm(filament)
+        is_cached = False
+        if cache == True and self.tool_count > 2 and new_filament >= 0:
+            if not self.is_in_same_filament_group(new_filament, filament):
+                filament_cache[filament - 1] = True
+                unload_distance = self.get_bowden_cache_mm(filament)
+                is_cached = True
+        phases['unload_bowden'] = unload_distance / self.filament_homing_speed_mms
+        distance = extruder_distance + unload_distance
+        if not is_cached:
+            filament_cache[filament - 1] = False
+            if self.rome_setup == 1:
+                phases['unload_bowden'] += self.estimate_parking()
+                distance = distance + self.y_sensor_to_parking_position_mm
+
+        return phases, distance
+
+    def estimate_load(self, filament, filament_cache, first, purge_length=0.):
+        phases = {}
+        extruder_distance = self.toolhead_sensor_to_extruder_gear_mm + self.extruder_gear_to_parking_position_mm
+
+        # cache or parking position to toolhead sensor
+        load_distance = self.get_bowden_parking_mm(filament)
+        if self.rome_setup == 0:
+            load_distance = self.get_bowden_cache_mm(filament)
+        phases['load_bowden'] = 0.
+        if self.use_filament_caching == True and self.tool_count > 2:
+            if filament_cache[filament - 1]:
+                load_distance = self.get_bowden_cache_mm(filament)
+            else:
+                filament_group = self.get_filament_group(filament)
+                if filament_group >= 0:
+                    for blocked_filament in self.Filament_Groups[filament_group]:
+                        if blocked_filament != filament and filament_cache[blocked_filament - 1]:
+                            eviction_distance = self.get_bowden_parking_mm(blocked_filament) - self.get_bowden_cache_mm(blocked_filament)
+                            phases['load_bowden'] += eviction_distance / self.filament_homing_speed_mms
+                            if self.rome_setup == 1:
+                                phases['load_bowden'] += self.estimate_parking() + 2 * self.cost_idler_select_time
+                            filament_cache[blocked_filament - 1] = False
+        filament_cache[filament - 1] = False
+        phases['load_bowden'] += load_distance / self.filament_homing_speed_mms + 4 * self.cost_sensor_step_time
+        distance = load_distance
+
+        # toolhead sensor to parking position, the push and pull test moves the distance twice more
+        load_parking_distance = extruder_distance
+        if self.extruder_push_and_pull_test:
+            load_parking_distance = load_parking_distance + 2 * (extruder_distance - 10)
+        phases['load_parking'] = load_parking_distance / self.filament_parking_speed_mms
+        distance = distance + load_parking_distance
+
+        # parking position to nozzle
+        if self.mode != "slicer" or first:
+            fast_distance, fast_speed, melt_distance, melt_speed = self.get_nozzle_loading_profile(purge_length)
+            phases['load_nozzle'] = fast_distance / fast_speed + melt_distance / melt_speed + 1.0
+            distance = distance + self.parking_position_to_nozzle_mm + purge_length
+
+        return phases, distance
+
+    def estimate_parking(self):
+        # y sensor search, fast and exact parking, final parking move
+        return 8 * self.cost_sensor_step_time + self.y_sensor_to_parking_position_mm / self.filament_homing_speed_mms
+
+    def learn_phase_cost(self, phase, duration):
+        estimate = self.Phase_Estimates.get(phase, 0.)
+        if estimate <= 0.:
+            return
+        factor = self.Cost_Factors.get(phase, 1.0)
+        self.Cost_Factors[phase] = factor + self.cost_model_smoothing * (duration / estimate - factor)
+
+    def get_phase_cost(self, phases):
+        cost = 0.
+        for phase, estimate in phases.items():
+            cost = cost + estimate * self.Cost_Factors.get(phase, 1.0)
+        return cost
+
+    def plan_tool_changes(self, sequence, loaded_filament, filament_cache, loaded_tool=-1):
+        filament_cache = list(filament_cache)
+        changes = []
+        for tool in sequence:
+            filament = self.get_mapped_tool(tool)
+            phases = {}
+            distance = 0.
+            if loaded_filament == filament and self.mode != "slicer":
+                changes.append({
+                    'from': loaded_filament,
+                    'to': filament,
+                    'phases': phases,
+                    'distance': distance
+                })
+                loaded_tool = tool
+                continue
+            if loaded_filament >= 1:
+                phases, distance = self.estimate_unload(loaded_filament, filament, filament_cache, self.use_filament_caching)
+            purge_length = 0.
+            if self.mode == "native" and loaded_filament >= 1 and self.use_ooze_ex == 1:
+                purge_length = self.get_purge_length(loaded_tool, tool)
+            load_phases, load_distance = self.estimate_load(filament, filament_cache, len(changes) == 0, purge_length)
+            phases.update(load_phases)
+            changes.append({
+                'from': loaded_filament,
+                'to': filament,
+                'phases': phases,
+                'distance': distance + load_distance
+            })
+            loaded_filament = filament
+            loaded_tool = tool
+        return changes
+
+    def get_remaining_change_time(self):
+        if self.Planned_Changes is None:
+            return None
+        completed_changes = max(0, self.Filament_Changes - 1)
+        remaining_time = 0.
+        for change in self.Planned_Changes[completed_changes:]:
+            remaining_time = remaining_time + self.get_phase_cost(change['phases'])
+        return remaining_time
+
+    def parse_sequence(self, sequence):
+        # slicer tool numbers like CHANGE_TOOL, returned 1-based like the purge matrix
+        tools = []
+        for tool in self.parse_lists(sequence, self.gcode.error):
+            filament = self.get_mapped_tool(tool[0] + 1)
+            if filament < 1 or filament > self.tool_count:
+                raise self.gcode.error("Invalid tool " + str(tool[0]))
+            tools.append(tool[0] + 1)
+        return tools
+
+    def cmd_ROME_PLAN(self, param):
+        sequence = self.parse_sequence(param.get('SEQUENCE'))
+        if len(sequence) == 0:
+            raise self.gcode.error("SEQUENCE is empty")
+        loaded_filament = -1
+        loaded_tool = -1
+        if self.Homed and self.toolhead_filament_sensor_triggered():
+            loaded_filament = self.Selected_Filament
+            loaded_tool = self.Slicer_Tool
+        changes = self.plan_tool_changes(sequence, loaded_filament, self.Filament_Cache, loaded_tool)
+
+        # the initial tool is already loaded
+        if loaded_filament == self.get_mapped_tool(sequence[0]):
+            changes = changes[1:]
+
+        total_time = 0.
+        total_distance = 0.
+        for change in changes:
+            total_time = total_time + self.get_phase_cost(change['phases'])
+            total_distance = total_distance + change['distance']
+        self.respond("Planned tool changes: " + str(len(changes)))
+        self.respond("Predicted change time: " + str(round(total_time, 1)) + "s")
+        if len(changes) > 0:
+            self.respond("Mean change time: " + str(round(total_time / len(changes), 1)) + "s")
+        self.respond("Filament moved: " + str(round(total_distance / 1000., 2)) + "m")
+        self.respond("Cost factors: " + ", ".join([phase + " " + str(round(factor, 2)) for phase, factor in sorted(self.Cost_Factors.items())]))
+
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Benchmark
+    # -----------------------------------------------------------------------------------------------------------------------------
+    def cmd_ROME_BENCHMARK(self, param):
+        cycles = param.get_int('CYCLES', 10, minval=1)
+        tools = [tool[0] for tool in self.parse_lists(param.get('TOOLS', '1,2'), self.gcode.error)]
+        for tool in tools:
+            if tool < 1 or tool > self.tool_count:
+                raise self.gcode.error("Invalid tool " + str(tool))
+        ooze_ex = param.get_int('OOZE_EX', 0, minval=0, maxval=1) == 1
+        z = param.get_float('Z', None, minval=0.)
+        temp = param.get_int('TEMP', -1, minval=-1, maxval=self.heater.max_temp)
+        cache = param.get_int('CACHE', 1 if self.use_filament_caching else 0, minval=0, maxval=1) == 1
+        result_file = os.path.expanduser(param.get('FILE', '~/rome_benchmark.json'))
+
+        # precheck
+        sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        if sdcard is not None and sdcard.is_active():
+            raise self.gcode.error("ROME_BENCHMARK can not run while printing")
+        if z is not None or ooze_ex:
+            homed_axes = self.toolhead.get_status(self.reactor.monotonic())['homed_axes']
+            if 'x' not in homed_axes or 'y' not in homed_axes or 'z' not in homed_axes:
+                raise self.gcode.error("Home the printer before running ROME_BENCHMARK")
+
+        self.save_state(True)
+        results = self.benchmark(cycles, tools, ooze_ex, z, temp, cache)
+        self.save_state()
+
+        # report
+        try:
+            with open(result_file, 'w') as f:
+                f.write(json.dumps(results, indent=2, sort_keys=True))
+        except (IOError, OSError):
+            logging.exception("rome: unable to write benchmark results to " + result_file)
+            self.respond("Could not write benchmark results to " + result_file)
+        self.respond("Tool changes: " + str(results['changes']) + ", failures: " + str(results['failures']) + ", retries: " + str(results['retries']))
+        self.respond("Throughput: " + str(round(results['changes_per_minute'], 2)) + " changes per minute")
+        if results['change_time']['count'] > 0:
+            self.respond("Change time: mean " + str(round(results['change_time']['mean'], 2)) + "s, p95 " + str(round(results['change_time']['p95'], 2)) + "s")
+        for phase in sorted(results['phases'].keys()):
+            self.respond("  " + phase + ": mean " + str(round(results['phases'][phase]['mean'], 2)) + "s, max " + str(round(results['phases'][phase]['max'], 2)) + "s")
+        if results['cache_hit_rate'] is not None:
+            self.respond("Cache hit rate: " + str(round(results['cache_hit_rate'] * 100, 1)) + "%")
+        self.respond("Benchmark results written to " + result_file)
+
+    def benchmark(self, cycles, tools, ooze_ex, z, temp, cache):
+        self.respond("Benchmarking " + str(cycles) + " cycles over tools " + str(tools))
+
+        # save state
+        saved_state = (self.mode, self.cmd_origin, self.exchange_old_position, self.Filament_Changes)
+        saved_statistics = dict(self.Statistics)
+        saved_metrics = self.get_metrics_snapshot()
+        self.run_gcode('SAVE_GCODE_STATE NAME=ROME_BENCHMARK')
+        if z is not None:
+            self.run_gcode('G90')
+            self.run_gcode('G0 Z' + str(z) + ' F600')
+            self.run_gcode('M400')
+
+        # run tool changes
+        self.mode = "native"
+        self.Phase_Recording = {}
+        change_times = []
+        failures = 0
+        start_time = self.reactor.monotonic()
+        try:
+            for cycle in range(cycles):
+                for tool in tools:
+                    if ooze_ex and self.toolhead_filament_sensor_triggered():
+                        self.cmd_origin = "rome"
+                        self.set_exchange_position()
+                    else:
+                        self.cmd_origin = "gcode"
+                        self.exchange_old_position = None
+                    change_start_time = self.reactor.monotonic()
+                    if not self.load_tool(tool, temp, cache):
+                        failures = failures + 1
+                        break
+                    change_times.append(self.reactor.monotonic() - change_start_time)
+                    self.Filament_Changes = self.Filament_Changes + 1
+                if failures > 0:
+                    self.respond("Benchmark aborted in cycle " + str(cycle + 1))
+                    break
+            duration = self.reactor.monotonic() - start_time
+            phases = self.Phase_Recording
+        finally:
+
+            # restore state, benchmark changes do not count as production changes
+            self.Phase_Recording = None
+            self.mode, self.cmd_origin, self.exchange_old_position, self.Filament_Changes = saved_state
+            statistics = {}
+            for statistic_name in self.statistic_names:
+                statistics[statistic_name] = self.Statistics[statistic_name] - saved_statistics[statistic_name]
+            self.Statistics = saved_statistics
+            self.restore_metrics_snapshot(saved_metrics)
+            self.run_gcode('RESTORE_GCODE_STATE NAME=ROME_BENCHMARK')
+
+        # results
+        cache_lookups = statistics['cache_hits'] + statistics['cache_misses']
+        results = {
+            'cycles': cycles,
+            'tools': tools,
+            'ooze_ex': ooze_ex,
+            'changes': len(change_times),
+            'failures': failures,
+            'duration': duration,
+            'changes_per_minute': len(change_times) / duration * 60. if duration > 0 else 0.,
+            'change_time': self.get_distribution(change_times),
+            'phases': {},
+            'retries': statistics['retries'],
+            'stalls': statistics['stalls'],
+            'cache_hits': statistics['cache_hits'],
+            'cache_misses': statistics['cache_misses'],
+            'cache_evictions': statistics['cache_evictions'],
+            'cache_hit_rate': statistics['cache_hits'] / float(cache_lookups) if cache_lookups > 0 else None
+        }
+        for phase, durations in phases.items():
+            results['phases'][phase] = self.get_distribution(durations)
+        return results
+
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Trace
+    # -----------------------------------------------------------------------------------------------------------------------------
+
+    def cmd_ROME_TRACE(self, param):
+        enable = param.get_int('ENABLE', 1, minval=0, maxval=1)
+        if enable == 1:
+            self.start_trace(os.path.expanduser(param.get('FILE', '~/rome_trace.jsonl')))
+        else:
+            self.stop_trace()
+
+    def start_trace(self, trace_file):
+        self.stop_trace()
+        try:
+            # line buffered, the trace survives a klipper crash
+            self.Trace = open(trace_file, 'w', 1)
+        except (IOError, OSError):
+            raise self.gcode.error("Unable to open trace file " + trace_file)
+        self.trace_event('start', trace_file, self.reactor.monotonic())
+        self.respond("ROME trace started: " + trace_file)
+
+    def stop_trace(self):
+        if self.Trace is None:
+            return
+        self.trace_event('stop', '', self.reactor.monotonic())
+        self.Trace.close()
+        self.Trace = None
+        self.respond("ROME trace stopped")
+
+    def trace_event(self, event_type, name, start_time, duration=0., value=None):
+        if self.Trace is None:
+            return
+        event = {
+            'type': event_type,
+            'name': name,
+            'time': round(start_time, 6),
+            'print_time': round(self.mcu.estimated_print_time(start_time), 6),
+            'duration': round(duration, 6),
+            'stack': self.Trace_Phases
+        }
+        if value is not None:
+            event['value'] = value
+        self.Trace.write(json.dumps(event, separators=(',', ':')) + '\n')
+
+    def trace_move(self, stepper, move_type, dist, wait, start_time):
+        if self.Trace is None:
+            return
+        self.trace_event(move_type, stepper.get_steppers()[0].get_name(), start_time, self.reactor.monotonic() - start_time, {'distance': dist, 'wait': wait})
+
+    def trace_sensor(self, sensor_name, triggered):
+        if self.Trace is not None:
+            self.trace_event('sensor', sensor_name, self.reactor.monotonic(), 0., triggered)
+        return triggered
+
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Sensor Telemetry
+    # -----------------------------------------------------------------------------------------------------------------------------
+    def register_sensor_telemetry(self):
+        # every filament switch sensor reports its transitions through the runout helper
+        for filament_sensor in self.printer.lookup_objects('filament_switch_sensor'):
+            runout_helper = filament_sensor[1].runout_helper
+            runout_helper.note_filament_present = self.get_sensor_telemetry_handler(runout_helper.name, runout_helper.note_filament_present)
+
+    def get_sensor_telemetry_handler(self, sensor_name, note_filament_present):
+        def handler(*args):
+            if self.sensor_telemetry:
+                self.record_sensor_transition(sensor_name, args)
+            return note_filament_present(*args)
+        return handler
+
+    def record_sensor_transition(self, sensor_name, args):
+        # newer klipper versions pass the event time of the mcu button report
+        eventtime = self.reactor.monotonic()
+        if len(args) > 1:
+            eventtime = args[0]
+        print_time = self.mcu.estimated_print_time(eventtime)
+        extruder_position = None
+        if hasattr(self.extruder, 'find_past_position'):
+            extruder_position = self.extruder.find_past_position(print_time)
+        self.Sensor_Telemetry.append((print_time, eventtime, sensor_name, bool(args[-1]), extruder_position, self.Selected_Filament, ';'.join(self.Trace_Phases)))
+
+    def cmd_ROME_SENSOR_TELEMETRY(self, param):
+        self.sensor_telemetry = param.get_int('ENABLE', 1, minval=0, maxval=1) == 1
+        size = param.get_int('SIZE', self.sensor_telemetry_size, minval=10)
+        if size != self.sensor_telemetry_size:
+            self.sensor_telemetry_size = size
+            self.Sensor_Telemetry = collections.deque(self.Sensor_Telemetry, maxlen=size)
+        self.respond("Sensor telemetry: " + str(self.sensor_telemetry) + ", " + str(len(self.Sensor_Telemetry)) + " of " + str(self.sensor_telemetry_size) + " transitions recorded")
+
+    def cmd_ROME_SENSOR_TELEMETRY_DUMP(self, param):
+        telemetry_file = os.path.expanduser(param.get('FILE', self.sensor_telemetry_file))
+        if not self.dump_sensor_telemetry(telemetry_file):
+            raise self.gcode.error("Unable to write sensor telemetry to " + telemetry_file)
+        if param.get_int('CLEAR', 0, minval=0, maxval=1) == 1:
+            self.Sensor_Telemetry.clear()
+
+    def dump_sensor_telemetry(self, telemetry_file):
+        last_transitions = {}
+        try:
+            with open(telemetry_file, 'w') as f:
+                f.write('print_time,eventtime,sensor,filament_present,extruder_position,since_last_transition,selected_filament,phase\n')
+                for print_time, eventtime, sensor_name, filament_present, extruder_position, selected_filament, phase in self.Sensor_Telemetry:
+
+                    # short intervals between transitions of one sensor point to a bouncing switch
+                    since_last_transition = ''
+                    if sensor_name in last_transitions:
+                        since_last_transition = '%.6f' % (print_time - last_transitions[sensor_name])
+                    last_transitions[sensor_name] = print_time
+                    if extruder_position is None:
+                        extruder_position = ''
+                    else:
+                        extruder_position = '%.3f' % extruder_position
+                    f.write('%.6f,%.6f,%s,%d,%s,%s,%d,%s\n' % (print_time, eventtime, sensor_name, filament_present, extruder_position, since_last_transition, selected_filament, phase))
+        except (IOError, OSError):
+            logging.exception("rome: unable to write sensor telemetry to " + telemetry_file)
+            return False
+        self.respond(str(len(self.Sensor_Telemetry)) + " sensor transitions written to " + telemetry_file)
+        return True
+
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Webhooks
+    # -----------------------------------------------------------------------------------------------------------------------------
+    Request_Messages = None
+
+    def register_endpoints(self):
+        webhooks = self.printer.lookup_object('webhooks')
+        webhooks.register_endpoint('rome/state', self.handle_state_request)
+        webhooks.register_endpoint('rome/load', self.handle_load_request)
+        webhooks.register_endpoint('rome/eject', self.handle_eject_request)
+        webhooks.register_endpoint('rome/home_lanes', self.handle_home_lanes_request)
+        webhooks.register_endpoint('rome/metrics', self.handle_metrics_request)
+
+    def handle_state_request(self, web_request):
+        web_request.send(self.get_status(self.reactor.monotonic()))
+
+    def handle_metrics_request(self, web_request):
+        web_request.send({
+            'content_type': 'text/plain; version=0.0.4',
+            'metrics': self.get_metrics_text()
+        })
+
+    def handle_load_request(self, web_request):
+        tool = web_request.get_int('tool')
+        temp = web_request.get_int('temp', -1)
+        self.get_request_lanes([tool])
+        with self.gcode.get_mutex():
+            self.check_request_allowed()
+            self.Request_Messages = []
+            try:
+                self.cmd_origin = "gcode"
+                self.save_state(True)
+                success = self.load_tool(tool, temp, True)
+                if success:
+                    self.save_state()
+            finally:
+                messages = self.Request_Messages
+                self.Request_Messages = None
+        web_request.send({
+            'tool': tool,
+            'success': success,
+            'selected_filament': self.Selected_Filament,
+            'messages': messages
+        })
+
+    def handle_eject_request(self, web_request):
+        lanes = self.get_request_lanes(web_request.get('lanes'))
+        with self.gcode.get_mutex():
+            self.check_request_allowed()
+            # only idle lanes move without the extruder, which would pull the loaded filament out of the hotend
+            if self.toolhead_filament_sensor_triggered():
+                busy_lanes = [lane for lane in lanes if self.rome_setup != 0 or not self.is_lane_idle(lane)]
+                if len(busy_lanes) > 0:
+                    raise self.gcode.error("Filament " + str(self.Selected_Filament) + " is loaded, unload the tool before ejecting " + ", ".join([str(lane) for lane in busy_lanes]))
+            self.Request_Messages = []
+            try:
+                self.save_state(True)
+                results = self.eject_filaments(lanes)
+                if all(results.values()):
+                    self.save_state()
+            finally:
+                messages = self.Request_Messages
+                self.Request_Messages = None
+        web_request.send({
+            'lanes': [{'lane': lane, 'success': results[lane]} for lane in lanes],
+            'success': all(results.values()),
+            'messages': messages
+        })
+
+    def handle_home_lanes_request(self, web_request):
+        lanes = self.get_request_lanes(web_request.get('lanes', list(range(1, self.tool_count + 1))))
+        with self.gcode.get_mutex():
+            self.check_request_allowed()
+            self.Request_Messages = []
+            results = {}
+            try:
+                self.save_state(True)
+                if not self.Homed:
+                    if not self.home():
+                        raise self.gcode.error("Can not home ROME!")
+                filament_present = self.scan_filaments()
+                for lane in lanes:
+                    if filament_present[lane - 1] == False:
+                        results[lane] = 'empty'
+                    elif self.home_filament(lane):
+                        results[lane] = 'homed'
+                    else:
+                        results[lane] = 'failed'
+                        break
+                if 'failed' not in results.values():
+                    self.save_state()
+            finally:
+                messages = self.Request_Messages
+                self.Request_Messages = None
+        web_request.send({
+            'lanes': [{'lane': lane, 'result': results.get(lane, 'skipped')} for lane in lanes],
+            'success': 'failed' not in results.values(),
+            'messages': messages
+        })
+
+    def get_request_lanes(self, lanes):
+        if not isinstance(lanes, list) or len(lanes) == 0:
+            raise self.gcode.error("Invalid lanes " + str(lanes))
+        for lane in lanes:
+            if not isinstance(lane, int) or lane < 1 or lane > self.tool_count:
+                raise self.gcode.error("Invalid lane " + str(lane))
+        return lanes
+
+    def check_request_allowed(self):
+        sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        if sdcard is not None and sdcard.is_active():
+            raise self.gcode.error("ROME is busy printing")
+
+    # -----------------------------------------------------------------------------------------------------------------------------
+    # Status
+    # -----------------------------------------------------------------------------------------------------------------------------
+    def get_status(self, eventtime):
+        tool_mapping = {}
+        for tool, mapped_tool in self.Tool_Mapping.items():
+            tool_mapping[str(tool)] = mapped_tool
+        filament_usage = []
+        spool_remaining = []
+        for i in range(1, self.tool_count + 1):
+            filament_usage.append(self.get_filament_usage(i))
+            spool_remaining.append(self.get_spool_remaining(i))
+        return {
+            'homed': self.Homed,
+            'selected_filament': self.Selected_Filament,
+            'filament_cache': list(self.Filament_Cache),
+            'infinite_spool': self.infinite_spool,
+            'tool_mapping': tool_mapping,
+            'filament_usage': filament_usage,
+            'spool_remaining': spool_remaining,
+            'filament_present': self.scan_filaments(),
+            'remaining_change_time': self.get_remaining_change_time(),
+            'lane_wear': self.get_lane_wear(),
+            'recoveries': list(self.Recovery_Log)[-10:],
+            'lane_moves': sorted(self.Lane_Moves.keys())
+        }
 
     # -----------------------------------------------------------------------------------------------------------------------------
     # Helper
     # -----------------------------------------------------------------------------------------------------------------------------
-    def stepper_move(self, stepper, dist, wait, speed, accel):
-        stepper.do_move(dist, speed, accel, True)
+    def stepper_move(self, stepper, dist, wait, speed, accel, sync=True):
+        start_time = self.reactor.monotonic()
+        stepper.do_move(dist, speed, accel, sync)
         if wait:
             self.toolhead.wait_moves()      
+        self.trace_move(stepper, 'move', dist, wait, start_time)
 
     def stepper_homing_move(self, stepper, dist, wait, speed, accel, homing_move):
+        start_time = self.reactor.monotonic()
         stepper.do_homing_move(dist, speed, accel, homing_move > 0, abs(homing_move) == 1)
         if wait:
             self.toolhead.wait_moves()      
+        self.trace_move(stepper, 'homing_move', dist, wait, start_time)
 
     def stepper_endstop_triggered(self, manual_stepper):
         endstop = manual_stepper.rail.get_endstops()[0][0]
         state = endstop.query_endstop(self.toolhead.get_last_move_time())
         return bool(state)
 
-    def stepper_driver_status(self, stepper_name):
-        driver_config = self.printer.lookup_object("tmc2209 manual_stepper " + stepper_name)
+    def get_rotation_distance(self, tool):
+        extruder_stepper = self.printer.lookup_object('extruder_stepper ' + self.get_lane_extruder(tool))
+        return extruder_stepper.extruder_stepper.stepper.get_rotation_distance()[0]
+
+    def set_rotation_distance(self, tool, rotation_distance):
+        self.run_gcode('SET_EXTRUDER_ROTATION_DISTANCE EXTRUDER=' + self.get_lane_extruder(tool) + ' DISTANCE=' + str(rotation_distance))
+
+    def stepper_driver(self, stepper_name, stepper_type='manual_stepper'):
+        return self.printer.lookup_object("tmc2209 " + stepper_type + " " + stepper_name, None)
+
+    def stepper_driver_status(self, stepper_name, stepper_type='manual_stepper'):
+        driver_config = self.stepper_driver(stepper_name, stepper_type)
         return driver_config.get_status()
 
+    def stepper_driver_stalled(self, driver):
+
+        # driver errors
+        drv_status = driver.mcu_tmc.get_register('DRV_STATUS')
+        for field_name in ['ot', 's2ga', 's2gb', 's2vsa', 's2vsb']:
+            if driver.fields.get_field(field_name, drv_status, 'DRV_STATUS'):
+                return True
+
+        # stallguard result
+        threshold = self.stallguard_threshold
+        if threshold < 0:
+            threshold = 2 * driver.fields.get_field('sgthrs')
+        sg_result = driver.fields.get_field('sg_result', driver.mcu_tmc.get_register('SG_RESULT'), 'SG_RESULT')
+        return sg_result < threshold
+
     def set_hotend_temperature(self, temp):
         
         # set hotend temperature
@@ -1256,20 +3409,47 @@ class ROME:
         # success
         return True
 
+    def parse_lists(self, value, error=None):
+        lists = []
+        try:
+            for items in value.split(','):
+                if items.strip() != '':
+                    lists.append([int(item) for item in items.split(':')])
+        except ValueError:
+            if error is None:
+                error = self.config.error
+            raise error("Unable to parse '" + value + "'")
+        return lists
+
+    # messages scripts/rome_log_analyzer.py reads from klippy.log, failures end with an exclamation mark
+    logged_message_prefixes = ('change_tool ', 'load_tool ', 'load_filament_from_', 'unload_filament_from_', 'Waiting for heater', 'tool ', 'Recovery ', 'Recovered ', 'auto loading filament ', 'eject filament', 'runout detected filament ', 'could not', 'Could not', 'Can not', 'Stall detected')
+
     def respond(self, message):
+        if self.Request_Messages is not None:
+            self.Request_Messages.append(message)
         self.gcode.respond_raw(message)
+        if self.log_messages or message.endswith('!') or message.startswith(self.logged_message_prefixes):
+            logging.info("rome: " + message)
+
+    def run_gcode(self, script):
+        if self.Trace is None:
+            self.gcode.run_script_from_command(script)
+            return
+        start_time = self.reactor.monotonic()
+        self.gcode.run_script_from_command(script)
+        self.trace_event('gcode', script, start_time, self.reactor.monotonic() - start_time)
 
     def toolhead_filament_sensor_triggered(self):
-        return bool(self.toolhead_filament_sensor.runout_helper.filament_present)
+        return self.trace_sensor('toolhead_filament_sensor', bool(self.toolhead_filament_sensor.runout_helper.filament_present))
 
-    def y_filament_sensor_triggered(self):
-        if self.Selected_Filament < 3:
-            if self.y1_filament_sensor != None:
-                return bool(self.y1_filament_sensor.runout_helper.filament_present)
-        else:
-            if self.y2_filament_sensor != None:
-                return bool(self.y2_filament_sensor.runout_helper.filament_present)
-        return False
+    def y_filament_sensor_triggered(self, filament=None):
+        if filament is None:
+            filament = self.Selected_Filament
+        if filament < 1 or filament > self.tool_count:
+            return False
+        if self.Lane_Y_Sensors[filament - 1] is None:
+            return False
+        return self.trace_sensor(self.Lane_Y_Sensor_Names[filament - 1], bool(self.Lane_Y_Sensors[filament - 1].runout_helper.filament_present))
 
     def enable_toolhead_filament_sensor(self):
         self.toolhead_filament_sensor.runout_helper.sensor_enabled = True
@@ -1280,6 +3460,16 @@ class ROME:
     def extruder_set_temperature(self, temperature, wait):
         self.pheaters.set_temperature(self.heater, temperature, wait)
 
+    def extruder_wait_for_extrude_temperature(self):
+        # keep a higher target temperature, only wait until extruding is possible
+        if self.get_target_temperature() < self.heater.min_extrude_temp:
+            self.extruder_set_temperature(self.heater.min_extrude_temp, True)
+        else:
+            self.run_gcode('TEMPERATURE_WAIT SENSOR=' + self.extruder.get_name() + ' MINIMUM=' + str(self.heater.min_extrude_temp))
+
+    def get_target_temperature(self):
+        return self.heater.get_temp(self.reactor.monotonic())[1]
+
     def extruder_can_extrude(self):
         status = self.extruder.get_status(self.toolhead.get_last_move_time())
         result = status['can_extrude'] 
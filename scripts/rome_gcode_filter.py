@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# Remove tool changes that extrude no filament before the next tool change
+#
+# T1 -> T2 -> T1 without printing anything with T2 becomes T1, a change to the
+# tool that is already active is dropped. Tool changes are T<n> or CHANGE_TOOL TOOL=<n>
+# lines, the wipe tower purge after a change does not count as printing.
+# Works as a slicer post-processing script.
+#
+# usage: rome_gcode_filter.py input.gcode [output.gcode] [--sequence]
+import os
+import re
+import sys
+import argparse
+
+tool_change_pattern = re.compile(r'^T(\d+)\s*(;.*)?$')
+change_tool_pattern = re.compile(r'^CHANGE_TOOL\s.*\bTOOL=(\d+)', re.IGNORECASE)
+move_pattern = re.compile(r'^G[01]\s')
+
+# comments of the slicers around the wipe tower and its purge moves
+purge_start_comments = ('CP TOOLCHANGE START', 'CP EMPTY GRID START', 'WIPE_TOWER_START')
+purge_end_comments = ('CP TOOLCHANGE END', 'CP EMPTY GRID END', 'WIPE_TOWER_END')
+purge_types = ('WIPE TOWER', 'PRIME TOWER')
+
+
+def get_parameter(line, name):
+    for word in line.split(';')[0].split()[1:]:
+        if word[0].upper() == name:
+            try:
+                return float(word[1:])
+            except ValueError:
+                return None
+    return None
+
+
+class GcodeFilter:
+    def __init__(self, output):
+        self.output = output
+        self.active_tool = None
+        self.relative_extrusion = False
+        self.e_position = 0.
+
+        # inside a wipe tower block or feature
+        self.purge_block = False
+        self.purge_type = False
+
+        # lines after a tool change that has not extruded anything yet, with a flag for tool change lines
+        self.pending_tool = None
+        self.pending_from_tool = None
+        self.pending_lines = []
+
+        self.sequence = []
+        self.tool_changes = 0
+        self.tool_change_lines = 0
+        self.removed_changes = 0
+
+    def process_line(self, line):
+        command = line.strip()
+
+        # tool change
+        match = tool_change_pattern.match(command) or change_tool_pattern.match(command)
+        if match:
+            self.tool_change_lines += 1
+            self.tool_change(int(match.group(1)), line)
+            return
+
+        # wipe tower
+        if command.startswith(';'):
+            self.process_comment(command.lstrip('; ').upper())
+
+        # extrusion mode
+        elif command.startswith('M82'):
+            self.relative_extrusion = False
+        elif command.startswith('M83'):
+            self.relative_extrusion = True
+        elif command.startswith('G92'):
+            e = get_parameter(command, 'E')
+            if e is not None:
+                self.e_position = e
+
+        # printing move
+        elif move_pattern.match(command):
+            e = get_parameter(command, 'E')
+            if e is not None:
+                extruded = e if self.relative_extrusion else e - self.e_position
+                if not self.relative_extrusion:
+                    self.e_position = e
+                printing = extruded > 0 and (get_parameter(command, 'X') is not None or get_parameter(command, 'Y') is not None)
+                if printing and not self.is_purging() and self.pending_tool is not None:
+                    self.commit_tool_change()
+
+        self.write(line)
+
+    def process_comment(self, comment):
+        if comment.startswith(purge_start_comments):
+            self.purge_block = True
+        elif comment.startswith(purge_end_comments):
+            self.purge_block = False
+            self.purge_type = False
+        elif comment.startswith('TYPE:'):
+            self.purge_type = comment[5:].strip() in purge_types
+
+    def is_purging(self):
+        return self.purge_block or self.purge_type
+
+    def tool_change(self, tool, line):
+        # CHANGE_TOOL and a T line of the same change
+        if tool == self.pending_tool:
+            self.pending_lines.append((line, True))
+            return
+
+        self.tool_changes += 1
+        if self.pending_tool is not None:
+            # the pending change did not extrude anything, drop it but keep the purge moves
+            self.removed_changes += 1
+            self.active_tool = self.pending_from_tool
+            self.pending_tool = None
+            pending_lines = self.pending_lines
+            self.pending_lines = []
+            for pending_line, change in pending_lines:
+                if not change:
+                    self.write(pending_line)
+
+        if tool == self.active_tool:
+            self.removed_changes += 1
+            return
+
+        self.pending_tool = tool
+        self.pending_from_tool = self.active_tool
+        self.pending_lines = [(line, True)]
+
+    def commit_tool_change(self):
+        self.active_tool = self.pending_tool
+        self.sequence.append(self.pending_tool)
+        self.pending_tool = None
+        pending_lines = self.pending_lines
+        self.pending_lines = []
+        for pending_line, change in pending_lines:
+            self.output.write(pending_line)
+
+    def write(self, line):
+        if self.pending_tool is not None:
+            self.pending_lines.append((line, False))
+        else:
+            self.output.write(line)
+
+    def finish(self):
+        # a change at the end of the file is kept, the end gcode may depend on it
+        if self.pending_tool is not None:
+            self.commit_tool_change()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Remove tool changes that extrude no filament")
+    parser.add_argument('input')
+    parser.add_argument('output', nargs='?', help="defaults to rewriting the input file")
+    parser.add_argument('--sequence', action='store_true', help="print the remaining tool sequence, e.g. for ROME_PLAN SEQUENCE=")
+    args = parser.parse_args()
+
+    output_file = args.output
+    if output_file is None:
+        output_file = args.input + '.tmp'
+    with open(args.input) as input_gcode, open(output_file, 'w') as output_gcode:
+        gcode_filter = GcodeFilter(output_gcode)
+        for line in input_gcode:
+            gcode_filter.process_line(line)
+        gcode_filter.finish()
+    if args.output is None:
+        os.replace(output_file, args.input)
+
+    sys.stderr.write("removed " + str(gcode_filter.removed_changes) + " tool changes\n")
+    if args.sequence:
+        print(",".join([str(tool) for tool in gcode_filter.sequence]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+# Reconstruct ROME tool changes from klippy.log files and report latency and failures
+#
+# Every argument is one printer, either a directory with its klippy.log files or a single
+# log file, NAME=PATH names the printer. Rotated (klippy.log.2024-01-01, klippy.log.1) and
+# compressed (.gz, .bz2, .xz) logs are streamed oldest first, only the aggregates are kept.
+# Times come from the Stats lines klippy writes every second, durations have a resolution of
+# about one second. Phases need the ROME messages in the log, older logs only contain the
+# load_tool, auto load, eject and runout lines and yield whole changes.
+#
+# usage: rome_log_analyzer.py printer1/ printer2=/backup/printer2/klippy.log.gz [--csv report.csv]
+import os
+import re
+import bz2
+import gzip
+import lzma
+import argparse
+
+stats_pattern = re.compile(r'^Stats (\d+(?:\.\d+)?):')
+start_pattern = re.compile(r'^Start printer at ')
+number_pattern = re.compile(r'\d+')
+failure_pattern = re.compile(r'could not|cant |can not|jammed|not completed|stall detected|should not|should be triggered|too cold|stuck|not found|failed', re.IGNORECASE)
+
+# messages that start a phase of a tool change
+phase_messages = {
+    'unload_filament_from_nozzle_to_parking_position': 'unload_nozzle',
+    'unload_filament_from_parking_position_to_toolhead_sensor': 'unload_parking',
+    'unload_filament_from_toolhead_sensor': 'unload_bowden',
+    'load_filament_from_reverse_bowden_to_toolhead_sensor': 'load_bowden',
+    'load_filament_from_toolhead_sensor_to_parking_position': 'load_parking',
+    'Waiting for heater...': 'heating',
+    'load_filament_from_parking_position_to_nozzle': 'load_nozzle'
+}
+
+# messages of rome actions that are counted per lane but not timed
+event_messages = [
+    ('auto loading filament ', 'autoload'),
+    ('eject filament ', 'eject'),
+    ('runout detected filament ', 'runout')
+]
+
+compressed_extensions = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+# seconds, the last bucket collects everything above
+duration_buckets = [1, 2, 3, 5, 7, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300, 600]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(duration_buckets) + 1)
+        self.count = 0
+        self.total = 0.
+        self.maximum = 0.
+
+    def add(self, value):
+        index = len(duration_buckets)
+        for i, bucket in enumerate(duration_buckets):
+            if value <= bucket:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+    def get_quantile(self, quantile):
+        # upper bound of the bucket that contains the quantile
+        if self.count == 0:
+            return 0.
+        limit = quantile * self.count
+        count = 0
+        for i, bucket_count in enumerate(self.counts):
+            count += bucket_count
+            if count >= limit:
+                if i < len(duration_buckets):
+                    return min(duration_buckets[i], self.maximum)
+                return self.maximum
+        return self.maximum
+
+    def get_mean(self):
+        if self.count == 0:
+            return 0.
+        return self.total / self.count
+
+
+class Report:
+    def __init__(self):
+        self.changes = Histogram()
+        self.phases = {}
+        self.failures = 0
+        self.incomplete = 0
+        self.skipped = 0
+        self.recovered = 0
+        self.recovery_attempts = 0
+        self.failure_reasons = {}
+        self.events = {}
+
+    def add_change(self, change):
+        if change['result'] == 'skipped':
+            self.skipped += 1
+            return
+        if change['result'] == 'incomplete':
+            self.incomplete += 1
+            return
+        self.recovery_attempts += change['recovery_attempts']
+        if change['result'] == 'failure':
+            self.failures += 1
+            reason = change['failure'] or 'unknown'
+            self.failure_reasons[reason] = self.failure_reasons.get(reason, 0) + 1
+            return
+        if change['recovery_attempts'] > 0:
+            self.recovered += 1
+        self.changes.add(change['duration'])
+        for phase, duration in change['phases'].items():
+            self.phases.setdefault(phase, Histogram()).add(duration)
+
+    def add_event(self, event, failure):
+        counts = self.events.setdefault(event, [0, 0])
+        counts[0] += 1
+        if failure:
+            counts[1] += 1
+
+
+class LogAnalyzer:
+    def __init__(self):
+        self.reports = {}
+        self.printer = None
+        self.now = None
+        self.last_message = None
+        self.change = None
+        self.event = None
+
+    def get_report(self, printer, lane=None):
+        return self.reports.setdefault((printer, lane), Report())
+
+    def start_printer(self, printer):
+        self.finish_printer()
+        self.printer = printer
+        self.now = None
+        self.last_message = None
+
+    def finish_printer(self):
+        self.close_change('incomplete')
+        self.close_event()
+
+    def process_line(self, line):
+        line = line.rstrip('\n')
+
+        # klippy logs the host monotonic time every second
+        match = stats_pattern.match(line)
+        if match:
+            self.now = float(match.group(1))
+            return
+
+        # restart, the monotonic clock and the rome state start over
+        if start_pattern.match(line):
+            self.close_change('failure', 'restart')
+            self.close_event()
+            self.now = None
+            return
+
+        # rome messages are written by respond() with a prefix, older lines without one
+        if line.startswith('rome: '):
+            message = line[6:]
+        else:
+            message = line
+
+        # the legacy logging line and the respond() line of the same action follow each other
+        if message == self.last_message:
+            return
+        self.last_message = message
+        self.process_message(message)
+
+    def process_message(self, message):
+        if self.now is None:
+            return
+
+        # tool change
+        if message.startswith('change_tool ') or message.startswith('load_tool '):
+            lane = get_lane(message)
+            if self.change is not None and self.change['lane'] == lane and self.change['result'] is None:
+                return
+            self.close_change('incomplete')
+            self.close_event()
+            self.change = {
+                'lane': lane,
+                'start': self.now,
+                'phase': None,
+                'phase_start': None,
+                'phases': {},
+                'failure': None,
+                'recovery_attempts': 0,
+                'result': None
+            }
+            return
+
+        # autoload, eject and runout
+        for prefix, event in event_messages:
+            if message.startswith(prefix):
+                self.close_event()
+                self.event = {'name': event, 'lane': get_lane(message), 'failure': False}
+                return
+
+        if self.change is not None:
+            self.process_change_message(message)
+        elif self.event is not None and failure_pattern.search(message):
+            self.event['failure'] = True
+
+    def process_change_message(self, message):
+        change = self.change
+        if message in phase_messages:
+            self.close_phase(change)
+            change['phase'] = phase_messages[message]
+            change['phase_start'] = self.now
+        elif message.startswith('Recovery attempt '):
+            change['recovery_attempts'] += 1
+        elif message.endswith(' already loaded'):
+            self.close_change('skipped')
+        elif message.startswith('tool ') and message.endswith(' loaded'):
+            self.close_change('success')
+        elif message == 'pause rome' or message.startswith('Recovery failed'):
+            self.close_change('failure')
+        elif failure_pattern.search(message) and change['failure'] is None:
+            change['failure'] = number_pattern.sub('N', message)
+
+    def close_phase(self, change):
+        if change['phase'] is not None:
+            duration = self.now - change['phase_start']
+            change['phases'][change['phase']] = change['phases'].get(change['phase'], 0.) + duration
+            change['phase'] = None
+
+    def close_change(self, result, failure=None):
+        change = self.change
+        if change is None:
+            return
+        self.change = None
+        self.close_phase(change)
+        change['duration'] = self.now - change['start']
+        if failure is not None and change['failure'] is None:
+            change['failure'] = failure
+        change['result'] = result
+        self.get_report(self.printer).add_change(change)
+        self.get_report(self.printer, change['lane']).add_change(change)
+
+    def close_event(self):
+        event = self.event
+        if event is None:
+            return
+        self.event = None
+        self.get_report(self.printer).add_event(event['name'], event['failure'])
+        self.get_report(self.printer, event['lane']).add_event(event['name'], event['failure'])
+
+
+def get_lane(message):
+    match = number_pattern.search(message)
+    if match is None:
+        return None
+    return int(match.group(0))
+
+
+def get_log_order(path):
+    name = os.path.basename(path)
+    for extension in compressed_extensions:
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    suffix = name[name.find('.log') + 4:].lstrip('.')
+
+    # logrotate numbers count backwards, dated rotations sort by date, the current log is last
+    if suffix == '':
+        return (2, 0, '')
+    if suffix.isdigit():
+        return (0, -int(suffix), '')
+    return (1, 0, suffix)
+
+
+def get_log_files(path):
+    if not os.path.isdir(path):
+        return [path]
+    files = [os.path.join(path, name) for name in os.listdir(path) if name.startswith('klippy') and '.log' in name]
+    return sorted(files, key=get_log_order)
+
+
+def open_log(path):
+    for extension, open_function in compressed_extensions.items():
+        if path.endswith(extension):
+            return open_function(path, 'rt', errors='replace')
+    return open(path, errors='replace')
+
+
+def get_printer(argument):
+    if '=' in argument and not os.path.exists(argument):
+        return argument.split('=', 1)
+    path = os.path.abspath(argument)
+    if os.path.isdir(path):
+        return os.path.basename(path), argument
+    return os.path.basename(os.path.dirname(path)), argument
+
+
+def format_report(name, report):
+    changes = report.changes
+    line = "%-24s %6d %5d %5d %5d %5d %7.1f %7.1f %7.1f %7.1f" % (
+        name, changes.count, report.failures, report.recovered, report.skipped, report.incomplete,
+        changes.get_mean(), changes.get_quantile(0.5), changes.get_quantile(0.95), changes.maximum)
+    return line
+
+
+def print_reports(analyzer):
+    header = "%-24s %6s %5s %5s %5s %5s %7s %7s %7s %7s" % ('', 'ok', 'fail', 'recov', 'skip', 'inc', 'mean', 'p50', 'p95', 'max')
+    printers = sorted(set([printer for printer, lane in analyzer.reports]))
+    for printer in printers:
+        report = analyzer.reports[(printer, None)]
+        print(printer)
+        print(header)
+        print(format_report('all lanes', report))
+        lanes = sorted([lane for report_printer, lane in analyzer.reports if report_printer == printer and lane is not None])
+        for lane in lanes:
+            print(format_report('lane ' + str(lane), analyzer.reports[(printer, lane)]))
+
+        if len(report.phases) > 0:
+            print("  phases")
+            for phase, histogram in sorted(report.phases.items(), key=lambda item: -item[1].total):
+                print("    %-20s %6d x  mean %6.1fs  p95 %6.1fs  max %6.1fs" % (phase, histogram.count, histogram.get_mean(), histogram.get_quantile(0.95), histogram.maximum))
+        if report.recovery_attempts > 0:
+            print("  recovery attempts: " + str(report.recovery_attempts))
+        if len(report.failure_reasons) > 0:
+            print("  failures")
+            for reason, count in sorted(report.failure_reasons.items(), key=lambda item: -item[1]):
+                print("    %6d  %s" % (count, reason))
+        for event, (count, failures) in sorted(report.events.items()):
+            print("  %-10s %6d, %d failed" % (event, count, failures))
+        print("")
+
+
+def write_csv(analyzer, csv_file):
+    phases = sorted(set([phase for report in analyzer.reports.values() for phase in report.phases]))
+    with open(csv_file, 'w') as f:
+        f.write(",".join(['printer', 'lane', 'changes', 'failures', 'recovered', 'skipped', 'incomplete', 'mean', 'p50', 'p95', 'max'] + [phase + '_p95' for phase in phases]) + "\n")
+        for (printer, lane), report in sorted(analyzer.reports.items(), key=lambda item: (item[0][0], item[0][1] or 0)):
+            changes = report.changes
+            row = [printer, 'all' if lane is None else str(lane), str(changes.count), str(report.failures), str(report.recovered), str(report.skipped), str(report.incomplete)]
+            row += ["%.1f" % value for value in (changes.get_mean(), changes.get_quantile(0.5), changes.get_quantile(0.95), changes.maximum)]
+            row += ["%.1f" % report.phases[phase].get_quantile(0.95) if phase in report.phases else '' for phase in phases]
+            f.write(",".join(row) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze ROME tool changes in klippy.log files")
+    parser.add_argument('printers', nargs='+', help="log directory or file of a printer, NAME=PATH names the printer")
+    parser.add_argument('--csv', help="write the per printer and per lane report to a csv file")
+    args = parser.parse_args()
+
+    analyzer = LogAnalyzer()
+    for argument in args.printers:
+        printer, path = get_printer(argument)
+        analyzer.start_printer(printer)
+        for log_file in get_log_files(path):
+            with open_log(log_file) as log:
+                for line in log:
+                    analyzer.process_line(line)
+    analyzer.finish_printer()
+
+    print_reports(analyzer)
+    if args.csv:
+        write_csv(analyzer, args.csv)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# Find the filament groups, lane mapping and caching settings with the lowest tool change time
+#
+# The tool sequences of past jobs are replayed against thousands of candidate configurations at
+# once, with the load, unload and caching rules of ROME's cost model (estimate_unload and
+# estimate_load in rome.py). A job is a gcode file (tool changes without extrusion are dropped
+# like rome_gcode_filter.py does) or a text file with one SEQUENCE= list of slicer tools per line.
+# The cache distances are hardware limits and taken from the config as they are.
+#
+# usage: rome_optimizer.py printer.cfg jobs/*.gcode sequences.txt [--candidates 2000]
+import os
+import re
+import sys
+import argparse
+import configparser
+import numpy as np
+
+from rome_gcode_filter import GcodeFilter
+
+# any line that looks like a tool change, to check that the filter recognized all of them
+tool_change_line_pattern = re.compile(r'^\s*(T\d+|CHANGE_TOOL\s)', re.IGNORECASE)
+
+# the same per step overheads as the cost model in rome.py
+cost_sensor_step_time = 0.3
+cost_idler_select_time = 1.0
+
+
+def parse_lists(value):
+    lists = []
+    for items in value.split(','):
+        if items.strip() != '':
+            lists.append([int(item) for item in items.split(':')])
+    return lists
+
+
+def read_rome_config(config_file):
+    parser = configparser.ConfigParser(inline_comment_prefixes=('#', ';'), strict=False, interpolation=None)
+    parser.read(config_file)
+    if not parser.has_section('rome'):
+        raise SystemExit("no [rome] section in " + config_file)
+    section = parser['rome']
+
+    def get_float(option, default):
+        return float(section.get(option, default))
+
+    tool_count = int(section.get('tool_count', 2))
+    config = {
+        'rome_setup': int(section.get('rome_setup', 0)),
+        'tool_count': tool_count,
+        'use_filament_caching': get_float('use_filament_caching', 1) == 1,
+        'extruder_push_and_pull_test': get_float('extruder_push_and_pull_test', 1) == 1,
+        'filament_groups': parse_lists(section.get('filament_groups', '1:2,4:5')),
+        'filament_homing_speed_mms': get_float('filament_homing_speed_mms', 75.0),
+        'filament_parking_speed_mms': get_float('filament_parking_speed_mms', 50.0),
+        'nozzle_loading_speed_mms': get_float('nozzle_loading_speed_mms', 10.0),
+        'nozzle_unload_time': get_float('nozzle_unload_time', 5.0),
+        'toolhead_sensor_to_bowden_cache_mm': get_float('toolhead_sensor_to_bowden_cache_mm', 100.0),
+        'toolhead_sensor_to_bowden_parking_mm': get_float('toolhead_sensor_to_bowden_parking_mm', 100.0),
+        'toolhead_sensor_to_extruder_gear_mm': get_float('toolhead_sensor_to_extruder_gear_mm', 45.0),
+        'extruder_gear_to_parking_position_mm': get_float('extruder_gear_to_parking_position_mm', 40.0),
+        'parking_position_to_nozzle_mm': get_float('parking_position_to_nozzle_mm', 65.0),
+        'y_sensor_to_parking_position_mm': get_float('y_sensor_to_parking_position_mm', 48.0)
+    }
+    for option, default in (('lane_bowden_cache_mm', 'toolhead_sensor_to_bowden_cache_mm'), ('lane_bowden_parking_mm', 'toolhead_sensor_to_bowden_parking_mm')):
+        config[option] = [config[default]] * tool_count
+        if section.get(option, None) is not None:
+            config[option] = [float(item) for item in section.get(option).split(',')]
+        if len(config[option]) != tool_count:
+            raise SystemExit(option + " needs " + str(tool_count) + " entries")
+    return config
+
+
+def read_jobs(job_files):
+    jobs = []
+    for job_file in job_files:
+        if job_file.endswith('.gcode'):
+            tool_change_lines = 0
+            with open(job_file, errors='replace') as gcode, open(os.devnull, 'w') as output:
+                gcode_filter = GcodeFilter(output)
+                for line in gcode:
+                    if tool_change_line_pattern.match(line):
+                        tool_change_lines += 1
+                    gcode_filter.process_line(line)
+                gcode_filter.finish()
+            if gcode_filter.tool_change_lines < tool_change_lines:
+                raise SystemExit(job_file + ": only " + str(gcode_filter.tool_change_lines) + " of " + str(tool_change_lines) + " tool change lines were recognized")
+            jobs.append(gcode_filter.sequence)
+            continue
+        with open(job_file) as f:
+            for line in f:
+                line = line.strip()
+                if line != '' and not line.startswith('#'):
+                    jobs.append([tool[0] for tool in parse_lists(line)])
+    return [remove_repeated_tools(job) for job in jobs if len(job) > 0]
+
+
+def remove_repeated_tools(sequence):
+    # rome skips changes to the tool that is already loaded
+    result = []
+    for tool in sequence:
+        if len(result) == 0 or result[-1] != tool:
+            result.append(tool)
+    return result
+
+
+class Candidates:
+    def __init__(self, lane_of_tool, lane_groups, caching):
+        # one row per candidate, lane and group numbers are 0-based, -1 = no group
+        self.lane_of_tool = np.asarray(lane_of_tool, dtype=np.int64)
+        self.lane_groups = np.asarray(lane_groups, dtype=np.int64)
+        self.caching = np.asarray(caching, dtype=bool)
+
+    def __len__(self):
+        return len(self.caching)
+
+    def get_filament_groups(self, index):
+        groups = {}
+        for lane, group in enumerate(self.lane_groups[index]):
+            if group >= 0:
+                groups.setdefault(group, []).append(lane + 1)
+        return ",".join([":".join([str(lane) for lane in lanes]) for lanes in sorted(groups.values())])
+
+    def get_tool_groups(self, index):
+        # the tools that share a bowden tube, the same for every lane mapping that only relabels lanes
+        groups = {}
+        for tool, lane in enumerate(self.lane_of_tool[index]):
+            group = self.lane_groups[index][lane]
+            if group >= 0:
+                groups.setdefault(group, []).append(tool)
+        return tuple(sorted([tuple(tools) for tools in groups.values()]))
+
+
+def get_lane_groups(filament_groups, tool_count):
+    lane_groups = [-1] * tool_count
+    for group, filaments in enumerate(filament_groups):
+        for filament in filaments:
+            if 1 <= filament <= tool_count:
+                lane_groups[filament - 1] = group
+    return lane_groups
+
+
+def generate_candidates(config, count, group_size, caching_values, rng):
+    tool_count = config['tool_count']
+
+    # the current configuration is the baseline
+    layouts = [(list(range(tool_count)), get_lane_groups(config['filament_groups'], tool_count))]
+
+    # random lane mappings and random groups of up to group_size neighbouring lanes in a random order
+    for i in range(count):
+        lane_of_tool = list(rng.permutation(tool_count))
+        lane_order = rng.permutation(tool_count)
+        lane_groups = [-1] * tool_count
+        group = 0
+        position = 0
+        while position < tool_count:
+            size = int(rng.integers(1, group_size + 1))
+            lanes = lane_order[position:position + size]
+            if len(lanes) > 1:
+                for lane in lanes:
+                    lane_groups[lane] = group
+                group += 1
+            position += size
+        layouts.append((lane_of_tool, lane_groups))
+
+    return combine_candidates(layouts, caching_values)
+
+
+def combine_candidates(layouts, caching_values):
+    lane_of_tool = []
+    lane_groups = []
+    caching = []
+    for layout in layouts:
+        for enabled in caching_values:
+            lane_of_tool.append(layout[0])
+            lane_groups.append(layout[1])
+            caching.append(enabled)
+    return Candidates(lane_of_tool, lane_groups, caching)
+
+
+def evaluate(config, candidates, jobs):
+    tool_count = config['tool_count']
+    splitter = config['rome_setup'] == 1
+    homing_speed = config['filament_homing_speed_mms']
+    parking_speed = config['filament_parking_speed_mms']
+    parking_mm = np.asarray(config['lane_bowden_parking_mm'])
+    cache_mm = np.asarray(config['lane_bowden_cache_mm'])
+    extruder_distance = config['toolhead_sensor_to_extruder_gear_mm'] + config['extruder_gear_to_parking_position_mm']
+    parking_estimate = 8 * cost_sensor_step_time + config['y_sensor_to_parking_position_mm'] / homing_speed
+
+    # phases that do not depend on the candidate
+    unload_fixed = config['nozzle_unload_time'] + extruder_distance / parking_speed
+    if splitter:
+        unload_fixed += cost_idler_select_time
+    load_parking_distance = extruder_distance
+    if config['extruder_push_and_pull_test']:
+        load_parking_distance += 2 * (extruder_distance - 10)
+    load_fixed = 4 * cost_sensor_step_time + load_parking_distance / parking_speed + config['parking_position_to_nozzle_mm'] / config['nozzle_loading_speed_mms'] + 1.0
+
+    count = len(candidates)
+    rows = np.arange(count)
+    lanes = np.arange(tool_count)
+    caching = candidates.caching & (tool_count > 2)
+    total_time = np.zeros(count)
+
+    for job in jobs:
+        cached = np.zeros((count, tool_count), dtype=bool)
+        loaded = np.full(count, -1)
+        for tool in job:
+            lane = candidates.lane_of_tool[:, tool]
+            group = candidates.lane_groups[rows, lane]
+
+            # unload, the old filament is cached when the new one arrives through another bowden tube
+            has_loaded = loaded >= 0
+            old_lane = np.maximum(loaded, 0)
+            old_group = candidates.lane_groups[rows, old_lane]
+            cache_old = caching & has_loaded & (group != old_group)
+            if splitter:
+                unload_distance = np.where(cache_old, cache_mm[old_lane], parking_mm[old_lane])
+                unload_time = unload_distance / homing_speed + np.where(cache_old, 0., parking_estimate)
+            else:
+                unload_time = cache_mm[old_lane] / homing_speed
+            total_time += np.where(has_loaded, unload_fixed + unload_time, 0.)
+            cached[rows[has_loaded], old_lane[has_loaded]] = cache_old[has_loaded]
+
+            # load, a cached filament of the same group has to be evicted first
+            is_cached = cached[rows, lane] & caching
+            blocked = cached & (candidates.lane_groups == group[:, None]) & (lanes[None, :] != lane[:, None])
+            blocked &= (caching & ~is_cached & (group >= 0))[:, None]
+            eviction_time = (parking_mm - cache_mm)[None, :] / homing_speed
+            if splitter:
+                eviction_time = eviction_time + parking_estimate + 2 * cost_idler_select_time
+            total_time += np.where(blocked, eviction_time, 0.).sum(axis=1)
+            cached &= ~blocked
+            if splitter:
+                load_distance = np.where(is_cached, cache_mm[lane], parking_mm[lane])
+            else:
+                load_distance = cache_mm[lane]
+            total_time += load_distance / homing_speed + load_fixed
+            cached[rows, lane] = False
+            loaded = lane
+
+    return total_time
+
+
+def improve(config, candidates, times, jobs, keep, rounds):
+    # swap the lanes of two tools in the best candidates while that saves time
+    tool_count = config['tool_count']
+    swaps = [(a, b) for a in range(tool_count) for b in range(a + 1, tool_count)]
+    for i in range(rounds):
+        best = np.argsort(times)[:keep]
+        lane_of_tool = np.repeat(candidates.lane_of_tool[best], len(swaps), axis=0)
+        for index, (a, b) in enumerate(swaps):
+            lane_of_tool[index::len(swaps), a] = candidates.lane_of_tool[best, b]
+            lane_of_tool[index::len(swaps), b] = candidates.lane_of_tool[best, a]
+        neighbours = Candidates(
+            lane_of_tool,
+            np.repeat(candidates.lane_groups[best], len(swaps), axis=0),
+            np.repeat(candidates.caching[best], len(swaps)))
+        neighbour_times = evaluate(config, neighbours, jobs)
+        if neighbour_times.min() >= times[best[0]]:
+            break
+        candidates = Candidates(
+            np.concatenate([candidates.lane_of_tool, neighbours.lane_of_tool]),
+            np.concatenate([candidates.lane_groups, neighbours.lane_groups]),
+            np.concatenate([candidates.caching, neighbours.caching]))
+        times = np.concatenate([times, neighbour_times])
+    return candidates, times
+
+
+def parse_values(value, parser):
+    return [parser(item) for item in value.split(',') if item.strip() != '']
+
+
+def print_candidate(candidates, times, index, baseline_time, changes):
+    saving = baseline_time - times[index]
+    print("%10.1fs  %5.1f%%  %6.2fs/change  groups %-16s caching %d  tools -> lanes %s" % (
+        times[index], 100. * saving / baseline_time if baseline_time > 0 else 0., times[index] / max(changes, 1),
+        candidates.get_filament_groups(index) or '-', candidates.caching[index],
+        " ".join([str(tool) + ":" + str(lane + 1) for tool, lane in enumerate(candidates.lane_of_tool[index])])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep ROME configurations against recorded tool sequences")
+    parser.add_argument('config', help="klipper config file with the [rome] section")
+    parser.add_argument('jobs', nargs='+', help="gcode files or text files with one tool sequence per line")
+    parser.add_argument('--candidates', type=int, default=2000, help="number of random lane mappings and group layouts")
+    parser.add_argument('--group-size', type=int, default=2, help="largest number of lanes that share a bowden tube")
+    parser.add_argument('--caching', default='0,1', help="use_filament_caching values to try")
+    parser.add_argument('--top', type=int, default=10, help="number of configurations to list")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    config = read_rome_config(args.config)
+    jobs = read_jobs(args.jobs)
+    if len(jobs) == 0:
+        raise SystemExit("no tool changes found")
+    for job in jobs:
+        if max(job) >= config['tool_count']:
+            raise SystemExit("tool " + str(max(job)) + " needs more than " + str(config['tool_count']) + " lanes")
+    changes = sum([len(job) for job in jobs])
+
+    caching_values = [value == 1 for value in parse_values(args.caching, int)]
+
+    # the configured caching setting comes first, it is the baseline
+    baseline = config['use_filament_caching']
+    caching_values = [baseline] + [value for value in caching_values if value != baseline]
+
+    rng = np.random.default_rng(args.seed)
+    candidates = generate_candidates(config, args.candidates, args.group_size, caching_values, rng)
+    times = evaluate(config, candidates, jobs)
+    candidates, times = improve(config, candidates, times, jobs, args.top, 5)
+    baseline_time = times[0]
+
+    sys.stderr.write("%d jobs, %d tool changes, %d configurations\n" % (len(jobs), changes, len(candidates)))
+    print("current configuration")
+    print_candidate(candidates, times, 0, baseline_time, changes)
+    print("")
+    print("best configurations")
+    # lane mappings with the same tool groups and the same time only relabel the lanes, without caching the groups do not matter
+    listed = set()
+    for index in np.argsort(times, kind='stable'):
+        tool_groups = None
+        if candidates.caching[index]:
+            tool_groups = candidates.get_tool_groups(index)
+        key = (round(float(times[index]), 3), tool_groups, bool(candidates.caching[index]))
+        if key in listed:
+            continue
+        listed.add(key)
+        print_candidate(candidates, times, index, baseline_time, changes)
+        if len(listed) >= args.top:
+            break
+
+    best = int(np.argmin(times))
+    print("")
+    print("[rome]")
+    print("filament_groups: " + (candidates.get_filament_groups(best) or ''))
+    print("use_filament_caching: " + str(int(candidates.caching[best])))
+    print("# load slicer tool n into lane: " + ", ".join([str(tool) + " -> " + str(lane + 1) for tool, lane in enumerate(candidates.lane_of_tool[best])]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# Replay and profile a ROME trace recorded with ROME_TRACE
+#
+# usage: rome_trace.py ~/rome_trace.jsonl [--timeline] [--folded] [--top 20]
+import sys
+import json
+import argparse
+
+
+def load_trace(trace_file):
+    events = []
+    with open(trace_file) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if line == '':
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # the last line is incomplete when klipper stopped while writing
+                sys.stderr.write("skipping invalid line " + str(line_number) + "\n")
+    return events
+
+
+def get_command(event):
+    if event['type'] == 'gcode':
+        return event['name'].split(' ')[0].upper()
+    return event['type'] + ' ' + event['name']
+
+
+def is_queue_drain(event):
+    if event['type'] == 'gcode':
+        return get_command(event) == 'M400'
+    if event['type'] in ('move', 'homing_move'):
+        return event['value']['wait']
+    return False
+
+
+def get_dwell_ms(event):
+    if event['type'] != 'gcode' or get_command(event) != 'G4':
+        return 0.
+    for argument in event['name'].split(' ')[1:]:
+        if argument.upper().startswith('P'):
+            return float(argument[1:])
+    return 0.
+
+
+def get_stack(event):
+    if len(event['stack']) == 0:
+        return 'idle'
+    return ';'.join(event['stack'])
+
+
+def profile(events):
+    result = {
+        'commands': {},
+        'stacks': {},
+        'phases': {},
+        'queue_drains': 0,
+        'queue_drain_time': 0.,
+        'dwell_ms': 0.,
+        'dwell_time': 0.,
+        'sensor_reads': 0
+    }
+    for event in events:
+        if event['type'] in ('start', 'stop'):
+            continue
+        if event['type'] == 'sensor':
+            result['sensor_reads'] += 1
+            continue
+        if event['type'] == 'phase':
+            phase = result['phases'].setdefault(event['name'], [0, 0.])
+            phase[0] += 1
+            phase[1] += event['duration']
+            continue
+
+        command = get_command(event)
+        entry = result['commands'].setdefault(command, [0, 0.])
+        entry[0] += 1
+        entry[1] += event['duration']
+
+        stack = get_stack(event) + ';' + command
+        result['stacks'][stack] = result['stacks'].get(stack, 0.) + event['duration']
+
+        if is_queue_drain(event):
+            result['queue_drains'] += 1
+            result['queue_drain_time'] += event['duration']
+        dwell_ms = get_dwell_ms(event)
+        if dwell_ms > 0:
+            result['dwell_ms'] += dwell_ms
+            result['dwell_time'] += event['duration']
+    return result
+
+
+def print_timeline(events):
+    if len(events) == 0:
+        return
+    # events are written when they end, replay them in the order they started
+    events = sorted(events, key=lambda event: (event['time'], len(event['stack'])))
+    start_time = events[0]['time']
+    for event in events:
+        line = "%10.3f %10.3f %8.3f  %-12s %s" % (event['time'] - start_time, event['print_time'], event['duration'], event['type'], event['name'])
+        if 'value' in event:
+            line += "  " + json.dumps(event['value'])
+        print(("  " * len(event['stack'])) + line)
+
+
+def print_folded(result):
+    # folded stacks for flamegraph.pl, sample counts are milliseconds
+    for stack, duration in sorted(result['stacks'].items()):
+        samples = int(round(duration * 1000))
+        if samples > 0:
+            print(stack.replace(' ', '_') + " " + str(samples))
+
+
+def print_profile(result, top):
+    print("Phases")
+    for phase, (count, duration) in sorted(result['phases'].items(), key=lambda item: -item[1][1]):
+        print("  %-24s %6d x %10.3fs  (mean %.3fs)" % (phase, count, duration, duration / count))
+
+    print("")
+    print("Commands (top " + str(top) + " by time)")
+    commands = sorted(result['commands'].items(), key=lambda item: -item[1][1])
+    for command, (count, duration) in commands[:top]:
+        print("  %-40s %6d x %10.3fs" % (command, count, duration))
+
+    print("")
+    print("Stacks (top " + str(top) + " by time)")
+    stacks = sorted(result['stacks'].items(), key=lambda item: -item[1])
+    for stack, duration in stacks[:top]:
+        print("  %10.3fs  %s" % (duration, stack))
+
+    print("")
+    print("Queue drains:  %d, %.3fs" % (result['queue_drains'], result['queue_drain_time']))
+    print("Dwell:         %.0fms requested, %.3fs spent" % (result['dwell_ms'], result['dwell_time']))
+    print("Sensor reads:  %d" % result['sensor_reads'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay and profile a ROME trace")
+    parser.add_argument('trace_file')
+    parser.add_argument('--timeline', action='store_true', help="print every event in order")
+    parser.add_argument('--folded', action='store_true', help="print folded stacks for flamegraph.pl")
+    parser.add_argument('--top', type=int, default=20, help="number of commands and stacks to list")
+    args = parser.parse_args()
+
+    events = load_trace(args.trace_file)
+    if args.timeline:
+        print_timeline(events)
+    elif args.folded:
+        print_folded(profile(events))
+    else:
+        print_profile(profile(events), args.top)
+
+
+if __name__ == '__main__':
+    main()